@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import string
 
 class ClassStruct:
     """
@@ -29,4 +28,4 @@ class Struct:
         s = []
         for key in self.__dict__:
             s += ["%s: %s" % (key, self.__dict__[key])]
-        return "{" + string.join(s, ", ") + "}"
+        return "{" + ", ".join(s) + "}"
@@ -41,22 +41,19 @@ See
 """
 
 import ctypes
+from collections import deque
 from collections import OrderedDict as odict
 import functools
+import mmap
+import multiprocessing
 import os
 import re
-import string
 import struct
+import subprocess
 
 from cstruct import Struct
 
 import lark
-# Monkey patch lark trees so they can compare to strings, see 
-# https://github.com/lark-parser/lark/issues/986
-# XXX Go through rules and remove .data and .value comparisons against strings
-#     and use straight node and token
-old_lark_tree_eq = lark.Tree.__eq__ 
-lark.Tree.__eq__ = lambda self, other: (self.data == other) if isinstance(other, str) else old_lark_tree_eq(self, other)
 
 import llvmlite.binding as llvm
 import llvmlite.ir as ir
@@ -78,39 +75,52 @@ binops = unpack_op_sign_names([
 
 unops = unpack_op_sign_names(["+:add", "-:sub", "~:bitnot", "!:not"])
 
-int_ops = set(["|", "&", "^", "%", "<<", ">>", "!", "~"])
-rel_ops = set(["<", "<=", ">", ">=","==", "!="])
-logic_ops = set(["&&", "||"])
-ass_ops = set(["=", "*=", "/=", "%=", "+=", "-=", "<<=", ">>=", "&=", "^=", "|="])
-incr_ops = set([ "++", "--" ])
+# These are lookup-only, frozenset makes the immutability explicit
+int_ops = frozenset(["|", "&", "^", "%", "<<", ">>", "!", "~"])
+rel_ops = frozenset(["<", "<=", ">", ">=","==", "!="])
+logic_ops = frozenset(["&&", "||"])
+ass_ops = frozenset(["=", "*=", "/=", "%=", "+=", "-=", "<<=", ">>=", "&=", "^=", "|="])
+# Binary operation sign for each compound assignment, precomputed so "a += b"
+# doesn't slice a new string per expression
+compound_to_binop_sign = dict((op, op[:-1]) for op in ass_ops if len(op) > 1)
+incr_ops = frozenset([ "++", "--" ])
 
-binop_sign_to_name = { binop_sign : binop_name for binop_sign, binop_name in binops }
+# binops entries are already (sign, name) pairs, dict() builds the mapping in C
+binop_sign_to_name = dict(binops)
 
 # XXX Missing memory operators * . -> &
 # XXX Missing conditional operator ? :
 
 
-unspecified_integer_types = set(["_Bool", "char", "short", "int", "long", "long long"])
-float_types = set(["float", "double", "long double"])
+unspecified_integer_types = frozenset(["_Bool", "char", "short", "int", "long", "long long"])
+float_types = frozenset(["float", "double", "long double"])
 unspecified_types = unspecified_integer_types | float_types
-specifiable_integer_types = unspecified_integer_types - set(["_Bool"])
+specifiable_integer_types = unspecified_integer_types - frozenset(["_Bool"])
 
 # XXX Remove signed versions which map to plain anyway, and map to the non
 #     specified type and standardize on unsigned and plain at symbol table
 #     creation time?
-integer_specifiers = set(["unsigned", "signed"])
-specified_integer_types = set(
-    [(integer_specif + " " + integer_type) for integer_specif in integer_specifiers for integer_type in specifiable_integer_types]
+integer_specifiers = frozenset(["unsigned", "signed"])
+specified_integer_types = frozenset(
+    (integer_specif + " " + integer_type) for integer_specif in integer_specifiers for integer_type in specifiable_integer_types
 )
 integer_types = unspecified_integer_types | specified_integer_types
 
 # XXX Note on clang char is signed on x86, unsigned on ARM
-unsigned_integer_types = set(["_Bool"] + [integer_type for integer_type in integer_types if "unsigned" in integer_type])
+unsigned_integer_types = frozenset(["_Bool"] + [integer_type for integer_type in integer_types if "unsigned" in integer_type])
 signed_integer_types = integer_types - unsigned_integer_types
 
+# Map each integer type to its form with the sign specifier removed, eg
+# "unsigned long" to "long", built once so the lookup replaces per-call
+# string replaces and strips
+to_unspecified_integer_type = {
+    integer_type : (integer_type.replace("unsigned", "").replace("signed", "").strip() or "int")
+        for integer_type in integer_types
+}
+
 # XXX Missing _Complex
 non_void_types = float_types | integer_types
-all_types = float_types | integer_types | set(["void"])
+all_types = float_types | integer_types | frozenset(["void"])
 
 
 class SymbolTable():
@@ -130,23 +140,21 @@ class SymbolTable():
         self.scope_symbols = [dict(), dict()]
 
     def get(self, key, default):
-        # XXX Do this without exceptions
-        try:
-            return self.__getitem__(key)
-
-        except KeyError:
-            return default
+        item = self.__getitem__(key)
+        return default if (item is None) else item
 
     def __getitem__(self, key):
         assert isinstance(key, str)
-        item = None
-        # Search the item in all the scopes, except for overflow
-        for symbols in reversed(self.scope_symbols[:-1]):
-            item = symbols.get(key, None)
+        # Search the item in all the scopes innermost first, except for
+        # overflow. Index backwards instead of reversed(slice) so no list copy
+        # is allocated per lookup
+        scope_symbols = self.scope_symbols
+        for i in xrange(len(scope_symbols) - 2, -1, -1):
+            item = scope_symbols[i].get(key, None)
             if (item is not None):
-                break
-            
-        return item
+                return item
+
+        return None
 
     def __setitem__(self, key, value):
         self.scope_symbols[-2][key] = value 
@@ -172,6 +180,12 @@ class SymbolTable():
         assert len(self) == 1, "Setting overflow items on a local scope!!!"
         self.scope_symbols[-1][key] = value
 
+    def set_overflow_items(self, key_values):
+        # Batched version of set_overflow_item, checks the scope and fetches
+        # the overflow dict once for the whole batch
+        assert len(self) == 1, "Setting overflow items on a local scope!!!"
+        self.scope_symbols[-1].update(key_values)
+
     def push_scope(self):
         # The overflow now becomes the current and a new oveflow is created
         self.scope_symbols.append(dict())
@@ -182,53 +196,113 @@ class SymbolTable():
         self.scope_symbols[-1] = dict()
 
 
+# Memo for get_fn_name, the domain is the small set of operation and type
+# combinations but the names are rebuilt on every conversion and binop
+fn_name_cache = {}
+
+# Built lark parsers keyed on grammar file path, mtime and parser flavor
+parser_cache = {}
+
+# Integer literal suffix characters to C type, keyed on the uppercased suffix
+integer_suffix_types = {
+    "" : "int",
+    "U" : "unsigned int",
+    "L" : "long",
+    "UL" : "unsigned long", "LU" : "unsigned long",
+    "LL" : "long long",
+    "ULL" : "unsigned long long", "LLU" : "unsigned long long",
+}
+
+# Shared constant nodes keyed on the raw literal lexeme; real sources repeat
+# literals like 0 and 1 heavily and the nodes are never mutated once built
+integer_constant_cache = {}
+floating_constant_cache = {}
+
 def get_fn_name(*args):
     """
-    Return a function name based on the incoming arguments: operation name, 
+    Return a function name based on the incoming arguments: operation name,
     result type, parameter 1 type, parameter 2 type ...
     """
+    fn_name = fn_name_cache.get(args, None)
+    if (fn_name is None):
+        # fn = "name__result_type__a_type__b_type..."
+        l = [ args[0] ]
+        # Replace spaces in case of compound types ("unsigned long", etc)
+        l.extend([arg.replace(" ", "_") for arg in args[1:]])
+
+        fn_name = "__".join(l)
+        fn_name_cache[args] = fn_name
+
+    return fn_name
 
-    # fn = "name__result_type__a_type__b_type..."
-    l = [ args[0] ]
-    # Replace spaces in case of compound types ("unsigned long", etc)
-    l.extend([arg.replace(" ", "_") for arg in args[1:]])
-    
-    return string.join(l, "__")
 
+# The type representation is fixed (str is scalar, list is array or pointer,
+# odict is struct, see the comment in get_llvmlite_type) and never subclassed,
+# so the dispatch helpers use type() identity which skips the MRO walk
+# isinstance() does
 
 def type_is_scalar(t):
     # XXX Missing checking the symbol table for typedefs
-    return isinstance(t, str)
+    return type(t) is str
 
 def type_is_struct_or_union(t):
-    return (isinstance(t, (dict, odict)))
+    return (type(t) is odict) or (type(t) is dict)
 
 def type_is_array(t):
-    return isinstance(t, list)
+    return type(t) is list
+
+def type_equals(a_type, b_type):
+    """
+    @return True if the two types are structurally equal
+
+    Scalars are plain strings, arrays nest [item_type, dim] lists and structs
+    are odicts of field name to field type. Array dimensions are ir nodes (or
+    None for unsized), different nodes for the same constant dimension must
+    compare equal so they are compared by their ir text.
+    """
+    if (type(a_type) is not type(b_type)):
+        return False
+
+    if (type(a_type) is str):
+        return (a_type == b_type)
+
+    if (type(a_type) is list):
+        a_dim, b_dim = a_type[1], b_type[1]
+        if ((a_dim is None) != (b_dim is None)):
+            return False
+        if ((a_dim is not None) and (str(a_dim.ir_reg) != str(b_dim.ir_reg))):
+            return False
+        return type_equals(a_type[0], b_type[0])
+
+    # Structs, compare field names and types in declaration order
+    if (len(a_type) != len(b_type)):
+        return False
+    for (a_name, a_field_type), (b_name, b_field_type) in zip(a_type.items(), b_type.items()):
+        if ((a_name != b_name) or (not type_equals(a_field_type, b_field_type))):
+            return False
+    return True
 
 def type_is_compile_time_sized_array(t):
     """
     @return True if the type is an array and its size is known at compile time
     """
-    res = False
-    if (isinstance(t, list)):
-        if (isinstance(t[0], list)):
-            res = type_is_compile_time_sized_array(t[0])
-        else:
-            res = (t[1] is not None) and (isinstance(t[1].ir_reg, ir.Constant))
-            
-    else:
-        res = False
+    # Descend iteratively to the innermost array level instead of recursing,
+    # multi-dimensional arrays nest one list per dimension
+    while ((type(t) is list) and (type(t[0]) is list)):
+        t = t[0]
 
-    return res
+    return ((type(t) is list) and (t[1] is not None) and
+            isinstance(t[1].ir_reg, ir.Constant))
 
 def get_array_item_type(t):
     assert(type_is_array(t))
 
+    # Inline the list check, a helper call per nesting level adds up on
+    # multi-dimensional arrays
     a_type = t
-    while (type_is_array(a_type)):
-        a_type, _ = a_type
-        
+    while (type(a_type) is list):
+        a_type = a_type[0]
+
     return a_type
 
 def build_type_from_dimensions(item_type, dims):
@@ -247,34 +321,183 @@ def build_type_from_dimensions(item_type, dims):
     return array_type
 
 
+uncanonical_to_canonical_type = {
+    "char signed" : "signed char",
+    "char unsigned" : "unsigned char",
+    "int unsigned" : "unsigned int",
+    "int signed" : "signed int",
+    "unsigned" : "unsigned int",
+    "signed" : "signed int",
+    "long unsigned" : "unsigned long",
+    "long signed" : "signed long",
+    "long unsigned long" : "unsigned long long",
+    "long long unsigned" : "unsigned long long",
+    "long signed long" : "signed long long",
+    "long long signed" : "signed long long",
+    "double long" : "long double"
+}
+
 def get_canonical_type(t):
     """
     Get the canonical type for a c type, ie specifier first, type second eg
     "unsigned int" for "int unsigned"
-    
+
     If the type is not a basic type, the type is returned unmodified
     """
-    uncanonical_to_canonical_type = {
-        "char signed" : "signed char",
-        "char unsigned" : "unsigned char",
-        "int unsigned" : "unsigned int",
-        "int signed" : "signed int",
-        "unsigned" : "unsigned int",
-        "signed" : "signed int",
-        "long unsigned" : "unsigned long",
-        "long signed" : "signed long",
-        "long unsigned long" : "unsigned long long",
-        "long long unsigned" : "unsigned long long",
-        "long signed long" : "signed long long",
-        "long long signed" : "signed long long",
-        "double long" : "long double"
-    }
+    # This is called for every declaration and operator resolution, the table
+    # is built once at import and type() is used over isinstance() since the
+    # type representation is never subclassed
+    return uncanonical_to_canonical_type.get(t, t) if (type(t) is str) else t
+
+
+# Types sorted by highest rank first
+# XXX Review this really matches the c99 rank or find a way of
+#     extracting the result type of the C snippets or from some table
+#     we build out of invoking clang with all the different combinations
+# Ranks
+#  float < double < long double
+#  _Bool < char < short < int < long < long long
+# signed and unsigned have the same rank
+# the lowest ranked floating type has a higher rank than any integer
+type_ranks = {
+    "long double" : 8,
+    "double" : 7,
+    "float" : 6,
+    "long long" : 5,
+    "signed long long" : 5,
+    "unsigned long long" : 5,
+    "long" : 4,
+    "signed long": 4,
+    "unsigned long" : 4,
+    "int" : 3,
+    "signed int" : 3,
+    "unsigned int" : 3,
+    "short" : 2,
+    "signed short" : 2,
+    "unsigned short" : 2,
+    "char" : 1,
+    "signed char" : 1,
+    "unsigned char" : 1,
+    "_Bool" : 0,
+}
+# Make sure we are covering all specified types
+assert all((c_type in non_void_types) for c_type in type_ranks)
+assert all((c_type in type_ranks) for c_type in non_void_types)
+
+type_sizes = {
+    "long double" : 16,
+    "double" : 8,
+    "float" : 4,
+    "long long" : 8,
+    "signed long long" : 8,
+    "unsigned long long" : 8,
+    # XXX This depends on LLP64 vs LP64 windows is LLP64
+    "long" : 4,
+    "signed long" : 4,
+    "unsigned long" : 4,
+    "int" : 4,
+    "signed int" : 4,
+    "unsigned int" : 4,
+    "short" : 2,
+    "signed short" : 2,
+    "unsigned short" : 2,
+    "char" : 1,
+    "signed char" : 1,
+    "unsigned char" : 1,
+    "_Bool" : 1,
+}
+
+def compute_result_type(a_type, b_type):
+    """
+    Compute the usual arithmetic conversion result type for a pair of operand
+    types, used to prebuild the cross product table at import time
+    """
+    # See https://www.oreilly.com/library/view/c-in-a/0596006977/ch04.html
+    # See 6.3 conversions of ISO/IEC 9899:1999
+    # Every integer has a rank
+    #  _bool < char < short < int < long < long long
+    # rank(enum) = rank(compatible int type)
+    # rank(signed type) = rank(unsigned type)
+    # Floating point are ranked
+    #  float < double < long double
+    # Integer promotion:
+    # - if an int can represent all ranges of a type, an int is used
+    # - else an unsigned int
+    # plain char signedness is implementation dependent (on clang signed on x86
+    # but unsigned on arm)
+    # Bool: Any type is 0 if equals to 0, otherwise 1
+    # ... more conversion rules
+    # Usual arithmetic conversions 6.3.1.8
+
+    def a_or_b_type_is(c_type):
+        return ((a_type == c_type) or (b_type == c_type))
+
+    if (a_or_b_type_is("long double")):
+        res_type = "long double"
+
+    elif (a_or_b_type_is("double")):
+        res_type = "double"
+
+    elif (a_or_b_type_is("float")):
+        res_type = "float"
 
-    if (isinstance(t, str)):
-        t = uncanonical_to_canonical_type.get(t, t)
+    else:
+        # The type is integer, do integer promotions
+        assert(a_type in integer_types)
+        assert(b_type in integer_types)
+
+        a_promoted_type = a_type
+        b_promoted_type = b_type
+
+        # If an int can represent all the values of the original type
+        # use int otherwise unsigned int
+        if (type_sizes[a_type] < type_sizes["int"]):
+            a_promoted_type = "int"
+        if (type_sizes[b_type] < type_sizes["int"]):
+            b_promoted_type = "int"
+        # XXX Missing 6.3.1.3 rules
+
+        if (type_ranks[a_promoted_type] >= type_ranks[b_promoted_type]):
+            highest_ranked_type, lowest_ranked_type = a_promoted_type, b_promoted_type
+        else:
+            highest_ranked_type, lowest_ranked_type = b_promoted_type, a_promoted_type
+
+        # apply rules to promoted operands
+        if (a_promoted_type == b_promoted_type):
+            # Same promoted type, pick any
+            res_type = a_promoted_type
+
+        elif ((a_promoted_type in signed_integer_types) == (b_promoted_type in signed_integer_types)):
+            # Both are signed or both are unsigned, return highest ranked type
+            res_type = highest_ranked_type
+
+        elif (highest_ranked_type in unsigned_integer_types):
+            # unsigned has higher or equal rank, pick unsigned
+            res_type = highest_ranked_type
+
+        elif (type_sizes[highest_ranked_type] > type_sizes[lowest_ranked_type]):
+            # highest ranked type is signed and can represent all the values of the unsigned, pick signed
+            res_type = highest_ranked_type
+
+        else:
+            # pick unsigned type of the signed type
+            if (a_promoted_type in signed_integer_types):
+                res_type = a_promoted_type
+            else:
+                res_type = b_promoted_type
+
+            if (res_type != "_Bool"):
+                res_type = "unsigned " + res_type.replace("signed", "").strip()
+
+    return res_type
+
+# Cross product table of operand types to usual arithmetic result type, built
+# once at import so the per-binop cost is a single dict lookup
+result_type_table = {
+    (a_type, b_type) : compute_result_type(a_type, b_type)
+        for a_type in non_void_types for b_type in non_void_types
+}
 
-    return t
-    
 
 def get_llvm_type_ext(t):
     """
@@ -297,42 +520,111 @@ def get_llvm_type_ext(t):
     return c_to_irext.get(t, "")
 
 
+# Type mapping tables, built once at import time since they are consulted on
+# every IR generation node and rebuilding them per call is pure overhead
+
+# XXX Use some of the existing type list or snippets to build these?
+# XXX Calling the getters on every IR generation is error prone, should we
+#     store this type in the symbol and have get_llvm_result_type, etc?
+#     Or just keep the llvm type around?
+c_to_llvm_types = {
+    # XXX On windows "long double" is "double", on linux it's "x86_fp80"
+    "long double" : "double",
+    "double" : "double",
+    "float" : "float",
+    "long long" :"i64",
+    "signed long long" : "i64",
+    "unsigned long long" : "i64",
+    # XXX This depends on LLP64/etc windows is 32-bit
+    "long": "i32",
+    "signed long" : "i32",
+    "unsigned long" : "i32",
+    "int" : "i32",
+    "signed int": "i32",
+    "unsigned int" : "i32",
+    "short" : "i16",
+    "signed short" : "i16",
+    "unsigned short" : "i16",
+    "char" : "i8",
+    "signed char" : "i8",
+    "unsigned char" : "i8",
+    "_Bool" : "i1",
+    "void" : "void",
+}
+
+# Shared llvmlite type singletons, constructed once at import
+ir_i1, ir_i8, ir_i16, ir_i32, ir_i64 = (
+    ir.IntType(1), ir.IntType(8), ir.IntType(16), ir.IntType(32), ir.IntType(64))
+ir_float, ir_double, ir_void = ir.FloatType(), ir.DoubleType(), ir.VoidType()
+ir_pi8 = ir_i8.as_pointer()
+# Zero i32 constant shared by the getelementptr dereferences, constants are
+# immutable in llvmlite so one instance can appear in many instructions
+ir_i32_0 = ir_i32(0)
+
+c_to_llvmlite_types  = {
+    # XXX By default this is the same as double on Windows x86 instead of x86_fp80,
+    #     also llvmlite.ir doesn't support x86_fp80
+    "long double" : ir_double,
+    "double" : ir_double,
+    "float" : ir_float,
+    "long long" : ir_i64,
+    "signed long long" : ir_i64,
+    "unsigned long long" : ir_i64,
+    # XXX This depends on LLP64/etc windows is 32-bit
+    "long": ir_i32,
+    "signed long" : ir_i32,
+    "unsigned long" : ir_i32,
+    "int" : ir_i32,
+    "signed int": ir_i32,
+    "unsigned int" : ir_i32,
+    "short" : ir_i16,
+    "signed short" : ir_i16,
+    "unsigned short" : ir_i16,
+    "char" : ir_i8,
+    "signed char" : ir_i8,
+    "unsigned char" : ir_i8,
+    "_Bool" : ir_i1,
+    "void" : ir_void,
+}
+
+c_to_ctypes = {
+    "long double" : ctypes.c_longdouble,
+    "double" : ctypes.c_double,
+    "float" : ctypes.c_float,
+    "long long" : ctypes.c_longlong,
+    "signed long long" : ctypes.c_longlong,
+    "unsigned long long" : ctypes.c_ulonglong,
+    "long": ctypes.c_long,
+    "signed long" : ctypes.c_long,
+    "unsigned long" : ctypes.c_ulong,
+    "int" : ctypes.c_int,
+    "signed int": ctypes.c_int,
+    "unsigned int" : ctypes.c_uint,
+    "short" : ctypes.c_short,
+    "signed short" : ctypes.c_short,
+    "unsigned short" : ctypes.c_ushort,
+    "char" : ctypes.c_char,
+    "signed char" : ctypes.c_byte,
+    "unsigned char" : ctypes.c_ubyte,
+    "_Bool" : ctypes.c_bool,
+    "void" : None,
+    # XXX Missing ctypes.c_voidp once pointers are supported
+}
+
+def validate_type_tables():
+    # Make sure the tables are covering all types, checked once at import time
+    # instead of on every lookup
+    for type_table in (c_to_llvm_types, c_to_llvmlite_types, c_to_ctypes):
+        assert all((c_type in all_types) for c_type in type_table)
+        assert all((c_type in type_table) for c_type in all_types)
+
+validate_type_tables()
+
+
 def get_llvm_type(t):
     """
     Return the llvm type corresponding to a C type
     """
-    # XXX Use some of the existing type list or snippets to build this?
-    # XXX Calling this on every IR generation is error prone, should we 
-    #     store this type in the symbol and have get_llvm_result_type, etc?
-    #     Or just keep the llvm type around?
-    c_to_llvm_types = {
-        # XXX On windows "long double" is "double", on linux it's "x86_fp80"
-        "long double" : "double",
-        "double" : "double",
-        "float" : "float",
-        "long long" :"i64",
-        "signed long long" : "i64",
-        "unsigned long long" : "i64", 
-        # XXX This depends on LLP64/etc windows is 32-bit
-        "long": "i32",
-        "signed long" : "i32",
-        "unsigned long" : "i32",
-        "int" : "i32",
-        "signed int": "i32",
-        "unsigned int" : "i32",
-        "short" : "i16",
-        "signed short" : "i16",
-        "unsigned short" : "i16",
-        "char" : "i8",
-        "signed char" : "i8",
-        "unsigned char" : "i8",
-        "_Bool" : "i1",
-        "void" : "void",
-    }
-    # Make sure we are covering all types
-    assert all((c_type in all_types) for c_type in c_to_llvm_types)
-    assert all((c_type in c_to_llvm_types) for c_type in all_types)
-    
     return c_to_llvm_types[t]
 
 
@@ -341,36 +633,6 @@ def get_llvmlite_type(t):
     Return the llvmlite ir type corresponding to a C type
     """
 
-    c_to_llvmlite_types  = {
-        # XXX By default this is the same as double on Windows x86 instead of x86_fp80, 
-        #     also llvmlite.ir doesn't support x86_fp80
-        "long double" : ir.DoubleType(),
-        "double" : ir.DoubleType(),
-        "float" : ir.FloatType(),
-        "long long" : ir.IntType(64),
-        "signed long long" : ir.IntType(64),
-        "unsigned long long" : ir.IntType(64), 
-        # XXX This depends on LLP64/etc windows is 32-bit
-        "long": ir.IntType(32),
-        "signed long" : ir.IntType(32),
-        "unsigned long" : ir.IntType(32),
-        "int" : ir.IntType(32),
-        "signed int": ir.IntType(32),
-        "unsigned int" : ir.IntType(32),
-        "short" : ir.IntType(16),
-        "signed short" : ir.IntType(16),
-        "unsigned short" : ir.IntType(16),
-        "char" : ir.IntType(8),
-        "signed char" : ir.IntType(8),
-        "unsigned char" : ir.IntType(8),
-        "_Bool" : ir.IntType(1),
-        "void" : ir.VoidType(),
-    }
-    # Make sure we are covering all types
-    assert all((c_type in all_types) for c_type in c_to_llvmlite_types)
-    assert all((c_type in c_to_llvmlite_types) for c_type in all_types)
-
-
     # First stab at complex types
     #   "int" is "int"
     #   "unsigned int" is "unsigned int"
@@ -418,11 +680,12 @@ def get_llvmlite_type(t):
     # struct { int i:2; int j:3; } odict({'i' : "int:3"
     
     if (isinstance(t, str)):
-        # Primitive type
+        # Primitive type, a single lookup on the precomputed table which acts
+        # as the memo for the common scalar case
         # XXX or typedef, but typedef not supported yet
-        llvmlite_type = c_to_llvmlite_types[t]
+        return c_to_llvmlite_types[t]
 
-    elif (isinstance(t, list)):
+    if (isinstance(t, list)):
         # Array or pointer
         if ((t[1] is not None) and (isinstance(t[1].ir_reg, ir.Constant))):
             # Compile-time sized array
@@ -436,7 +699,9 @@ def get_llvmlite_type(t):
 
     elif (isinstance(t, odict)):
         # Struct
-        llvmlite_type = ir.LiteralStructType(get_llvmlite_type(field_type) for field_type in t.values())
+        # Pass a materialized tuple instead of a generator so llvmlite gets a
+        # sized sequence and no per-field generator frames are run
+        llvmlite_type = ir.LiteralStructType(tuple(get_llvmlite_type(field_type) for field_type in t.values()))
         
     else:
         assert False, "Unexpected type %s" % repr(t)
@@ -447,39 +712,12 @@ def get_ctype(t):
     """
     Return the Python ctype corresponding to a C type
     """
-    c_to_ctypes = {
-        "long double" : ctypes.c_longdouble,
-        "double" : ctypes.c_double,
-        "float" : ctypes.c_float,
-        "long long" : ctypes.c_longlong,
-        "signed long long" : ctypes.c_longlong,
-        "unsigned long long" : ctypes.c_ulonglong, 
-        "long": ctypes.c_long,
-        "signed long" : ctypes.c_long,
-        "unsigned long" : ctypes.c_ulong,
-        "int" : ctypes.c_int,
-        "signed int": ctypes.c_int,
-        "unsigned int" : ctypes.c_uint,
-        "short" : ctypes.c_short,
-        "signed short" : ctypes.c_short,
-        "unsigned short" : ctypes.c_ushort,
-        "char" : ctypes.c_char,
-        "signed char" : ctypes.c_byte,
-        "unsigned char" : ctypes.c_ubyte,
-        "_Bool" : ctypes.c_bool,
-        "void" : None,
-        # XXX Missing ctypes.c_voidp once pointers are supported
-    }
-    # Make sure we are covering specified types
-    assert all((c_type in all_types) for c_type in c_to_ctypes)
-    assert all((c_type in c_to_ctypes) for c_type in all_types)
-
-    
     if (isinstance(t, str)):
+        # Primitive type, a single lookup on the precomputed table
         # XXX Missing typedefs
-        ctype = c_to_ctypes[t]
+        return c_to_ctypes[t]
 
-    elif (isinstance(t, list)):
+    if (isinstance(t, list)):
         if ((t[1] is not None) and isinstance(t[1].ir_reg, ir.Constant)):
             # Compile-time sized array
             ctype = get_ctype(t[0]) * t[1].ir_reg.constant
@@ -498,28 +736,42 @@ def get_ctype(t):
     return ctype
 
 
+# External tool paths, resolved once at import instead of rebuilding the
+# abspath/dirname/join chain on every invocation
+# clang_exe_filepath = R"C:\android-ndk-r15c\toolchains\llvm\prebuilt\windows-x86_64\bin\clang.exe"
+# Directory this module lives in, used to locate bundled tools and data
+epycc_dirpath = os.path.dirname(os.path.abspath(__file__))
+
+# Debug prints (and dot generation) are only enabled when running epycc.py as a
+# script, evaluate the check once instead of on every call to the hot functions
+debug_prints = (__name__ == "__main__")
+clang_exe_filepath = os.path.join(epycc_dirpath, "_out", "bin", "clang.exe")
+dot_exe_filepath = os.path.join(epycc_dirpath, "_out", "bin", "dot.exe")
+
+def invoke_tool(cmd):
+    # Spawn with an argv list, skipping the intermediate shell and its escaping
+    # Like os.system, return a non-zero code instead of raising when the tool
+    # is missing, callers tolerate failures and fall back to whatever output
+    # files are already on disk (eg the pregenerated irs.ll)
+    try:
+        return subprocess.call(cmd)
+
+    except OSError:
+        print "Unable to invoke", cmd[0]
+        return 127
+
 def invoke_clang(c_filepath, ir_filepath, options=""):
     # Generate the precompiled IR in irs.ll
-    # clang_filepath = R"C:\android-ndk-r15c\toolchains\llvm\prebuilt\windows-x86_64\bin\clang.exe"
-    clang_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_out", "bin", "clang.exe")
     # For privacy reasons and since some ir files are pushed to the repo, don't
-    # leak the local path in the LLVM moduleid comment of 
-    cmd = R"%s -S -std=c99 -emit-llvm -mllvm --x86-asm-syntax=intel %s -o %s %s" % (
-        clang_filepath,
-        options,
-        os.path.relpath(ir_filepath),
-        os.path.relpath(c_filepath)
-    )
-    os.system(cmd)
+    # leak the local path in the LLVM moduleid comment of
+    cmd = [clang_exe_filepath, "-S", "-std=c99", "-emit-llvm", "-mllvm", "--x86-asm-syntax=intel"]
+    cmd.extend(options.split())
+    cmd.extend(["-o", os.path.relpath(ir_filepath), os.path.relpath(c_filepath)])
+    invoke_tool(cmd)
 
 def invoke_dot(filepath):
-    dot_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_out", "bin", "dot.exe")
-    cmd = R"%s -Tpng -o %s.png %s" %(
-        dot_filepath,
-        os.path.relpath(filepath),
-        os.path.relpath(filepath)
-    )
-    os.system(cmd)
+    rel_filepath = os.path.relpath(filepath)
+    invoke_tool([dot_exe_filepath, "-Tpng", "-o", rel_filepath + ".png", rel_filepath])
 
 
 def precompile_c_snippets(generated_c_filepath, generated_ir_filepath):
@@ -544,12 +796,16 @@ def precompile_c_snippets(generated_c_filepath, generated_ir_filepath):
 
     # XXX Should the forced cast exist? The highest ranked type is used for
     #     operations anyway at codegen time?
-            
-    for unop_sign, unop_name in unops:
-        for c_type in non_void_types:
-            if ((unop_sign in int_ops) and (c_type not in integer_types)):
-                continue
 
+    # Split the types once so integer-only operations iterate just the integer
+    # types instead of testing membership on every iteration, sorted so the
+    # generated file is reproducible across runs
+    non_void_list = sorted(non_void_types)
+    int_list = [c_type for c_type in non_void_list if (c_type in integer_types)]
+
+    for unop_sign, unop_name in unops:
+        # Don't do integer-only operations on non-integer operands
+        for c_type in (int_list if (unop_sign in int_ops) else non_void_list):
             # int add__int__int(int a) { return (int) (+a); }
             fn = "%s %s(%s a) { return (%s) (%sa); }" % (
                 c_type, 
@@ -559,15 +815,12 @@ def precompile_c_snippets(generated_c_filepath, generated_ir_filepath):
                 unop_sign,
             )
 
-            l.append(fn + "\n")
+            l.append(fn)
 
     for binop_sign, binop_name in binops:
-        for c_type in non_void_types:
-            # Don't do integer-only operations (bitwise, mod) on non-integer
-            # operands
-            if ((binop_sign in int_ops) and (c_type not in integer_types)):
-                continue
-
+        # Don't do integer-only operations (bitwise, mod) on non-integer
+        # operands
+        for c_type in (int_list if (binop_sign in int_ops) else non_void_list):
             # char add__char__char__char(char a, char b) { return (char) (a + b); }
             fn = "%s %s(%s a, %s b) { return (%s) (a %s b); }" % (
                 c_type, 
@@ -577,13 +830,13 @@ def precompile_c_snippets(generated_c_filepath, generated_ir_filepath):
                 binop_sign,
             )
 
-            l.append(fn + "\n")
+            l.append(fn)
 
             # Assignment operators will be done as a = a + b
                 
     # Build the type conversion functions
-    for res_type in non_void_types:
-        for a_type in non_void_types:
+    for res_type in non_void_list:
+        for a_type in non_void_list:
             # No need to generate for the same type (but note the table is still
             # redundant for integer types since it contains eg signed int to int)
             if (a_type != res_type):
@@ -594,19 +847,51 @@ def precompile_c_snippets(generated_c_filepath, generated_ir_filepath):
                     a_type,
                     res_type,
                 )
-                l.append(fn + "\n")
+                l.append(fn)
 
 
-    # Generate the C functions file in irs.c
+    # Generate the C functions file in irs.c, joining and writing once
+    # instead of one write per line
     with open(generated_c_filepath, "w") as f:
-        f.writelines(l)
+        f.write("\n".join(l))
+        f.write("\n")
 
     invoke_clang(generated_c_filepath, generated_ir_filepath)
     
 
+# Regexes used by convert_to_clang_irs, compiled once at import instead of
+# once per translated function
+
+# Parse the function prototype
+# define [dso_local] [zeroext|signext] i32 @"f"(i32 [returned] %".1", i32 %".2")
+# define dso_local i32 @felse(i32, i32) local_unnamed_addr #0 {
+# define dso_local i32 @felse(i32, i32) {
+# define i32 @"fif"(i32 %".1")
+# define float @"arith_ops"(i32 %".1", i32 %".2")
+# define i32 @felse_dangling(i32 returned %.1, i32 %.2) local_unnamed_addr #0 {
+re_fn_define = re.compile(r'define (?:dso_local )?(?P<llvm_type>[^@]+) @"?(?P<name>[^"]+)"?\((?P<parameters>[^)]*)\)')
+
+# llvmliteir label declarations:
+# entry.endif:
+# llvmliteir register usage:
+# %".5" = load i32, i32* %".3"
+# %.3 = zext i1 %3 to i32
+# %spec.select = select i1 %2, i32 0, i32 %0
+# but skip label usage:
+# br i1 %".8", label %"entry.if", label %"entry.endif"
+# comments
+# forbody.preheader:                                ; preds = %entry
+# Phi node
+#  %.3.0.lcssa = phi float [ 0.000000e+00, %entry ], [ %phitmp, %forbody.preheader ]
+# XXX Register assign is what increments the register count and has to be
+#     at the beginning of the line, which simplifies things
+re_reg_label_decl = re.compile(r'(^%"?[.0-9a-z_]+"?)[, \n]|(^[^:\n]+):', re.MULTILINE)
+re_reg_label_decl_usage = re.compile(r'(%[^ ,)]+)|(^[^:]+:)')
+
+
 def convert_to_clang_irs(llvm_irs):
     """
-    Convert the provided function irs into IR that matches clang as close as 
+    Convert the provided function irs into IR that matches clang as close as
     possible so it can be easily compared vs. clang-generated IR.
 
     IR code generated by llvmlite IR and clang differ in register and label
@@ -660,13 +945,7 @@ def convert_to_clang_irs(llvm_irs):
     #     %".10" = load i32, i32* %".3"
     
     # Parse the function prototype
-    # define [dso_local] [zeroext|signext] i32 @"f"(i32 [returned] %".1", i32 %".2")
-    # define dso_local i32 @felse(i32, i32) local_unnamed_addr #0 {
-    # define dso_local i32 @felse(i32, i32) {
-    # define i32 @"fif"(i32 %".1") 
-    # define float @"arith_ops"(i32 %".1", i32 %".2") 
-    # define i32 @felse_dangling(i32 returned %.1, i32 %.2) local_unnamed_addr #0 {
-    m = re.search(r'define (?:dso_local )?(?P<llvm_type>[^@]+) @"?(?P<name>[^"]+)"?\((?P<parameters>[^)]*)\)', llvm_irs[0])
+    m = re_fn_define.search(llvm_irs[0])
     fn = Struct(**m.groupdict())
     if (fn.parameters.strip() == ""):
         # split will return one-element list with the empty string, just return
@@ -703,35 +982,21 @@ def convert_to_clang_irs(llvm_irs):
     # Skip the gap between parameters and body registers
     index_count += 1
 
-    # Since we need a second pass anyway for filling in the labels, 
+    # Since we need a second pass anyway for filling in the labels,
     # do a two-pass for everything, first build the reindexing table,
     # then substitute everything
-    # llvmliteir label declarations:
-    # entry.endif:
-    # llvmliteir register usage:
-    # %".5" = load i32, i32* %".3"
-    # %.3 = zext i1 %3 to i32
-    # %spec.select = select i1 %2, i32 0, i32 %0
-    # but skip label usage:
-    # br i1 %".8", label %"entry.if", label %"entry.endif"
-    # comments
-    # forbody.preheader:                                ; preds = %entry
-    # Phi node
-    #  %.3.0.lcssa = phi float [ 0.000000e+00, %entry ], [ %phitmp, %forbody.preheader ]
-    # XXX Register assign is what increments the register count and has to be
-    #     at the beginning of the line, which simplifies things
-    re_reg_label_decl = re.compile(r'(^%"?[.0-9a-z_]+"?)[, \n]|(^[^:\n]+):', re.MULTILINE)
-    re_reg_label_decl_usage = re.compile(r'(%[^ ,)]+)|(^[^:]+:)')
-
-    # Find all the labels
-    llvm_ir = string.join(llvm_irs[1:], "\n")
-    labels = re.findall(r"^([^:\n]+):", llvm_ir, re.MULTILINE)
-    labels = set(["%%%s" % label for label in labels])
+
+    # Scan the body once, the label declarations are the second group of the
+    # scan regex so the labels can be collected from the same matches instead
+    # of running a separate full-text findall pass
+    llvm_ir = "\n".join(llvm_irs[1:])
+    reg_label_decl_matches = list(re_reg_label_decl.finditer(llvm_ir))
+    labels = { "%" + m.group(2) for m in reg_label_decl_matches if (m.lastindex == 2) }
 
     name_to_index["%entry"] = "%%%d" % len(fn.parameters)
 
     # Ignore the first line with the define
-    for m in re_reg_label_decl.finditer(llvm_ir):
+    for m in reg_label_decl_matches:
         match_index = m.lastindex
         reg_label_name = m.group(match_index)
         if (reg_label_name not in name_to_index):
@@ -753,18 +1018,21 @@ def convert_to_clang_irs(llvm_irs):
 
                 # Usage:
                 # %"entry.endif" and %entry.endif to %n
-                name_to_index['%%"%s"' % reg_label_name] = "%%%d" % index_count
-                name_to_index['%%%s' % reg_label_name] = "%%%d" % index_count
+                # Format the index once, usages share the same string so every
+                # substitution is just a dict hit on the prebuilt text
+                index_str = "%%%d" % index_count
+                name_to_index['%"' + reg_label_name + '"'] = index_str
+                name_to_index["%" + reg_label_name] = index_str
 
                 # Declaration
                 # entry.endif: to "; <label>:5:"
                 name_to_index[reg_label_name + ":"] = "; <label>:%d:" % index_count
                 index_count += 1
 
-    debug = (__name__ == "__main__")
+    debug = debug_prints
     if (debug):
         print "before"
-        print string.join(llvm_irs, "\n")
+        print "\n".join(llvm_irs)
 
     # Perform the replacement and filter out the define, braces and
     # entry basic block label coming from llvmir since they mismatch
@@ -778,9 +1046,9 @@ def convert_to_clang_irs(llvm_irs):
             l = "define dso_local %s @%s(%s) {" % (
                 fn.llvm_type,
                 fn.name,
-                string.join([
+                ",".join([
                     ("%s" % parameter.llvm_type)
-                    for parameter in fn.parameters], ",")
+                    for parameter in fn.parameters])
             )
         
         elif (l.startswith("{") or l.startswith("entry:")):
@@ -790,15 +1058,26 @@ def convert_to_clang_irs(llvm_irs):
 
         else:
             # Perform the replacement for register usage, and label usage and declaration
-            # Note label usage 
+            # Note label usage
             #   br i1 %".8", label %"entry.if", label %"entry.endif"
-            l = re_reg_label_decl_usage.sub(lambda m: name_to_index[m.group(m.lastindex)], l)
+            # Walk the matches and join the segments instead of sub() with a
+            # lambda, which dispatches a Python callable per match
+            segments = []
+            last_end = 0
+            for m in re_reg_label_decl_usage.finditer(l):
+                segments.append(l[last_end:m.start()])
+                segments.append(name_to_index[m.group(m.lastindex)])
+                last_end = m.end()
+
+            if (last_end > 0):
+                segments.append(l[last_end:])
+                l = "".join(segments)
 
         reindexed_llvm_irs.append(l)
         
     if (debug):
         print "after"
-        print string.join(reindexed_llvm_irs, "\n")
+        print "\n".join(reindexed_llvm_irs)
 
     return reindexed_llvm_irs
     
@@ -808,21 +1087,28 @@ def generate_ir(generator, node):
     #     generate_node_ir that doesn't require passing the generator every time
 
     def get_grandson(node, parent_indices):
-        if (len(parent_indices) > 0):
-            node = get_grandson(node.children[parent_indices[0]], parent_indices[1:])
+        # Iterate instead of recursing, one frame per index adds up on the
+        # deeply indexed rules
+        for parent_index in parent_indices:
+            node = node.children[parent_index]
         return node
 
     def get_tree_tokens(node):
-        # XXX This could use 
-        #     all_tokens = tree.scan_values(lambda v: isinstance(v, Token))
-        # but it's not sure we want to be that Lark dependent yet
+        # Note lark's tree.scan_values(lambda v: isinstance(v, Token)) does
+        # this but it recurses a Python generator per tree level and only
+        # works on Tree nodes while callers can pass a bare Token, so the
+        # explicit stack below is both faster and more general
+        # Walk with an explicit stack instead of recursing, reversing the
+        # children so tokens come out in source order
         tokens = []
-        if (isinstance(node, lark.Token)):
-            tokens = [node.value]
+        stack = [node]
+        while (stack):
+            node = stack.pop()
+            if (isinstance(node, lark.Token)):
+                tokens.append(node.value)
 
-        else:
-            for child in node.children:
-                tokens.extend(get_tree_tokens(child))
+            else:
+                stack.extend(reversed(node.children))
 
         return tokens
 
@@ -836,172 +1122,25 @@ def generate_ir(generator, node):
         return a_type in signed_integer_types
 
     def get_unspecified_type(a_type):
-        if (is_integer_type(a_type)):
-            # Remove unsigned or signed from the type
-            a_type = a_type.replace("unsigned", "").replace("signed","").strip()
-            if (a_type == ""):
-                a_type = "int"
-
-        return a_type
+        # Integer types map through the precomputed table, any other type is
+        # returned unmodified
+        return to_unspecified_integer_type.get(a_type, a_type)
 
     def get_type_bytes(a_type):
-        type_sizes = {
-            "long double" : 16,
-            "double" : 8,
-            "float" : 4,
-            "long long" : 8,
-            "signed long long" : 8,
-            "unsigned long long" : 8,
-            # XXX This depends on LLP64 vs LP64 windows is LLP64
-            "long" : 4,
-            "signed long" : 4,
-            "unsigned long" : 4,
-            "int" : 4,
-            "signed int" : 4,
-            "unsigned int" : 4,
-            "short" : 2,
-            "signed short" : 2,
-            "unsigned short" : 2,
-            "char" : 1,
-            "signed char" : 1,
-            "unsigned char" : 1,
-            "_Bool" : 1,
-        }
-
+        # Single lookup on the module-level size table
         return type_sizes[a_type]
 
 
     def get_result_type(op_sign, a_type, b_type):
-        # Types sorted by highest rank first
-        # XXX Review this really matches the c99 rank or find a way of 
-        #     extracting the result type of the C snippets or from some table
-        #     we build out of invoking clang with all the different combinations
-        # Ranks
-        #  float < double < long double
-        #  _Bool < char < short < int < long < long long
-        # signed and unsigned have the same rank
-        # the lowest ranked floating type has a higher rank than any integer
-        type_ranks = {
-            "long double" : 8, 
-            "double" : 7,
-            "float" : 6, 
-            "long long" : 5,
-            "signed long long" : 5,
-            "unsigned long long" : 5,
-            "long" : 4,
-            "signed long": 4,
-            "unsigned long" : 4,
-            "int" : 3,
-            "signed int" : 3,
-            "unsigned int" : 3,
-            "short" : 2,
-            "signed short" : 2,
-            "unsigned short" : 2,
-            "char" : 1,
-            "signed char" : 1,
-            "unsigned char" : 1,
-            "_Bool" : 0,
-        }
-        # Make sure we are covering all specified types
-        assert all((c_type in non_void_types) for c_type in type_ranks)
-        assert all((c_type in type_ranks) for c_type in non_void_types)
-        
-        def get_ranked_types(a_type, b_type):
-            a_type_rank = type_ranks[a_type]
-            b_type_rank = type_ranks[b_type]
-            if (a_type_rank >= b_type_rank):
-                return a_type, b_type
-            else:
-                return b_type, a_type
-            
-        def a_or_b_type_is(c_type):
-            return ((a_type == c_type) or (b_type == c_type))
-    
-
-        # XXX This could prebuild the cross product table of operands and results
-        #     offline so it doesn't need to check at runtime
-
-
-        # See https://www.oreilly.com/library/view/c-in-a/0596006977/ch04.html
-        # See 6.3 conversions of ISO/IEC 9899:1999
-        # Every integer has a rank
-        #  _bool < char < short < int < long < long long
-        # rank(enum) = rank(compatible int type)
-        # rank(signed type) = rank(unsigned type)
-        # Floating point are ranked
-        #  float < double < long double
-        # Integer promotion:
-        # - if an int can represent all ranges of a type, an int is used
-        # - else an unsigned int
-        # plain char signedness is implementation dependent (on clang signed on x86
-        # but unsigned on arm)
-        # Bool: Any type is 0 if equals to 0, otherwise 1
-        # ... more conversion rules
-        # Usual arithmetic conversions 6.3.1.8
-        # The usual arithmetic conversions are performed implicitly for the following operators:
-
+        # The usual arithmetic conversion rules were run over the cross
+        # product of types at import time, per-binop this is one dict hit
         # XXX Missing checking the op is one of usual arithmetic:
         #     - Arithmetic operators with two operands: *, /, %, +, and -
         #     - Relational and equality operators: <, <=, >, >=, ==, and !=
         #     - The bitwise operators, &, |, and ^
         #     - The conditional operator, ?: (for the second and third operands)
+        return result_type_table[(a_type, b_type)]
 
-        if (a_or_b_type_is("long double")):
-            res_type = "long double"
-
-        elif (a_or_b_type_is("double")):
-            res_type = "double"
-
-        elif (a_or_b_type_is("float")):
-            res_type = "float"
-
-        else:
-            # The type is integer, do integer promotions
-            assert(is_integer_type(a_type))
-            assert(is_integer_type(b_type))
-
-            a_promoted_type = a_type
-            b_promoted_type = b_type
-
-
-            # If an int can represent all the values of the original type
-            # use int otherwise unsigned int
-            if (get_type_bytes(a_type) < get_type_bytes("int")):
-                a_promoted_type = "int"
-            if (get_type_bytes(b_type) < get_type_bytes("int")):
-                b_promoted_type = "int"
-            # XXX Missing 6.3.1.3 rules
-
-            highest_ranked_type, lowest_ranked_type = get_ranked_types(a_promoted_type, b_promoted_type)
-            # apply rules to promoted operands
-            if (a_promoted_type == b_promoted_type):
-                # Same promoted type, pick any
-                res_type = a_promoted_type
-
-            elif (is_signed_integer_type(a_promoted_type) == is_signed_integer_type(b_promoted_type)):
-                # Both are signed or both are unsigned, return highest ranked type
-                res_type = highest_ranked_type
-
-            elif (is_unsigned_integer_type(highest_ranked_type)):
-                # unsigned has higher or equal rank, pick unsigned
-                res_type = highest_ranked_type
-
-            elif (get_type_bytes(highest_ranked_type) > get_type_bytes(lowest_ranked_type)):
-                # highest ranked type is signed and can represent all the values of the unsigned, pick signed
-                res_type = highest_ranked_type
-
-            else:
-                # pick unsigned type of the signed type
-                if (is_signed_integer_type(a_promoted_type)):
-                    res_type = a_promoted_type
-                else:
-                    res_type = b_promoted_type
-
-                if (res_type != "_Bool"):
-                    res_type = "unsigned " + res_type.replace("signed", "").strip()
-                
-        return res_type
-    
     def get_ir_reg_and_type(a):
         # XXX All this reg and ref should probably be rethought, there's a lot
         #     of redundant loads ands stores, and on the other hand ephemeral
@@ -1013,11 +1152,15 @@ def generate_ir(generator, node):
     def get_ir_ref_reg_and_type(a):
         a_ir_ref = None
         if (a.type == "identifier"):
+            # Note the builder can only be bound inside this branch, constant
+            # nodes (eg parameter array dimensions) are converted before any
+            # function and builder exist
+            builder = generator.llvmir.builder
             sym = generator.symbol_table[a.value]
             a_type = sym.value_type
             a_ir_type = get_llvmlite_type(a_type)
 
-            if (not hasattr(sym, "ir_ref")):
+            if (sym.ir_ref is None):
                 if (
                     # Scalar variables
                     type_is_scalar(a_type) or 
@@ -1044,8 +1187,8 @@ def generate_ir(generator, node):
                     # Create allocas in the entry block so they are available
                     # everywhere even across disjoint basic blocks and don't get
                     # reallocated inside loops, etc
-                    with generator.llvmir.builder.goto_entry_block():
-                        sym.ir_ref = generator.llvmir.builder.alloca(a_ir_type)
+                    with builder.goto_entry_block():
+                        sym.ir_ref = builder.alloca(a_ir_type)
 
                 else:
                     # XXX Missing dealing with None dimensions, should look at
@@ -1077,20 +1220,19 @@ def generate_ir(generator, node):
 
                     # Multiply all dimensions to get the total size
                     a_type, dim = sym.value_type
-                    size_ir_reg = dim.ir_reg
                     # XXX This should use something more abstract like size_t
                     size_t_type = "unsigned long long"
                     size_ir_reg = generate_type_conversion_ir(generator, dim, size_t_type)
                     while (type_is_array(a_type)):
                         a_type, dim = a_type
                         dim_ir_reg = generate_type_conversion_ir(generator, dim, size_t_type)
-                        size_ir_reg = generator.llvmir.builder.mul(size_ir_reg, dim_ir_reg)
+                        size_ir_reg = builder.mul(size_ir_reg, dim_ir_reg)
                     
                     # Allocate the runtime sized array in the current block
                     # position 
                     # Note we have to allocate for the item type (eg int), not
                     # for the array type (eg int**)
-                    sym.ir_ref = generator.llvmir.builder.alloca(get_llvmlite_type(a_type), size_ir_reg)
+                    sym.ir_ref = builder.alloca(get_llvmlite_type(a_type), size_ir_reg)
                     # XXX Setting align = 16 to match clang, revisit
                     sym.ir_ref.align = 16
                     # Return the full type since the dimensions ir will be
@@ -1101,7 +1243,7 @@ def generate_ir(generator, node):
                 # If it has a register it means that it has an initial value, 
                 # copy from the register into the storage
                 # XXX Should things get reset on every basic block?
-                if (hasattr(sym, "ir_reg")):
+                if (sym.ir_reg is not None):
                     # This needs to happen in the entry block so disjoint blocks
                     # get the right value
                     # Note only parameters have an ir_reg without an ir_ref.
@@ -1109,8 +1251,8 @@ def generate_ir(generator, node):
                     # bubbled up, but the expression and assign initializing
                     # them will remain in the disjoint basic block
                     assert(sym.type == "parameter")
-                    with generator.llvmir.builder.goto_entry_block():
-                        generator.llvmir.builder.store(sym.ir_reg, sym.ir_ref)
+                    with builder.goto_entry_block():
+                        builder.store(sym.ir_reg, sym.ir_ref)
 
             # Load from the storage to a new register to make sure the register
             # value we use is uptodate            
@@ -1124,7 +1266,7 @@ def generate_ir(generator, node):
             #     content like ir_reg since it may be created in one basic block
             #     and not available on another (eg regs created in a "then" block
             #     are not available on "else" blocks)
-            sym.ir_reg = generator.llvmir.builder.load(sym.ir_ref)
+            sym.ir_reg = builder.load(sym.ir_ref)
             a_ir_ref = sym.ir_ref
             
             a_ir_reg = sym.ir_reg
@@ -1140,10 +1282,9 @@ def generate_ir(generator, node):
         else:
             a_ir_reg = a.ir_reg
             a_type = a.value_type
-            # Some ir will have ir_ref (pointers and arrays expressions), some
-            # won't
-            if (hasattr(a, "ir_ref")):
-                a_ir_ref = a.ir_ref
+            # Only some ir will have an ir_ref (pointers and arrays
+            # expressions), the rest carry None
+            a_ir_ref = a.ir_ref
 
         return a_ir_ref, a_ir_reg, a_type
 
@@ -1194,8 +1335,9 @@ def generate_ir(generator, node):
         Note this block will be discarded and not even compiled in unoptimized
         code.
         """
-        notreached_bb = generator.llvmir.builder.function.append_basic_block("notreached")
-        generator.llvmir.builder.position_at_start(notreached_bb)
+        builder = generator.llvmir.builder
+        notreached_bb = builder.function.append_basic_block("notreached")
+        builder.position_at_start(notreached_bb)
 
 
     def generate_branch_ir(target):
@@ -1203,56 +1345,74 @@ def generate_ir(generator, node):
         Utility function to trap branches on terminated blocks. This should 
         never happen since we use an unreachable block, see goto_unreachable_block
         """
-        if (generator.llvmir.builder.block.is_terminated):
+        builder = generator.llvmir.builder
+        if (builder.block.is_terminated):
             print "Trying to terminate already terminated block"
-            print str(generator.llvmir.builder.block)
+            print str(builder.block)
             print "to" 
             print str(target)
             print "in function"
-            print str(generator.llvmir.builder.function)
+            print str(builder.function)
 
             assert False
 
         else:
-            generator.llvmir.builder.branch(target)
+            builder.branch(target)
                 
     def generate_cbranch_ir(condition, target_true, target_false):
         """
         Utility function to trap cbranches on terminated blocks. This should 
         never happen since we use an unreachable block, see goto_unreachable_block
         """
-        if (generator.llvmir.builder.block.is_terminated):
+        builder = generator.llvmir.builder
+        if (builder.block.is_terminated):
             print "Trying to terminate already terminated block"
-            print str(generator.llvmir.builder.block)
+            print str(builder.block)
             print "to" 
             print str(target_true),
             print "with condition", str(condition)
             print "in function"
-            print str(generator.llvmir.builder.function)
+            print str(builder.function)
 
             assert False
 
         else:
-            generator.llvmir.builder.cbranch(condition, target_true, target_false)
+            builder.cbranch(condition, target_true, target_false)
+
+    def generate_bool_ir(generator, gen_node, reg_name = None):
+        """
+        Convert an expression node to _Bool, as needed by loop and if
+        conditions, returning the condition register
+        """
+        a_ir_reg, a_type = get_ir_reg_and_type(gen_node)
+        res_type = "_Bool"
+        if (a_type != res_type):
+            a_ir_reg = generate_extern_call_ir(generator, 
+                get_fn_name("cnv", res_type, a_type), res_type, [a_type, a_ir_reg])
+            if (reg_name is not None):
+                a_ir_reg.name = reg_name
+
+        return a_ir_reg
 
 
     def generate_extern_call_ir(generator, fn_name, res_type, arg_type_ir_regs):
-            
-        arg_types = arg_type_ir_regs[::2]
-        arg_ir_regs = arg_type_ir_regs[1::2]
+
         # ir builder errors out when declaring a function more than once, keep
         # it around for the next time
         fn_ir = generator.llvmir.externs.get(fn_name, None)
         if (fn_ir is None):
+            # Only the declaration needs the types, slice them out on the
+            # miss path only so the common already-declared call doesn't pay
+            # the llvmlite type conversions
             fn_llvmlite_type = ir.FunctionType(
-                get_llvmlite_type(res_type), 
-                [get_llvmlite_type(arg_type) for arg_type in arg_types]
+                get_llvmlite_type(res_type),
+                [get_llvmlite_type(arg_type) for arg_type in arg_type_ir_regs[::2]]
             )
 
             fn_ir = ir.Function(generator.llvmir.module, fn_llvmlite_type, fn_name)
             generator.llvmir.externs[fn_name] = fn_ir
 
-        res_ir_reg = generator.llvmir.builder.call(fn_ir, arg_ir_regs)
+        res_ir_reg = generator.llvmir.builder.call(fn_ir, arg_type_ir_regs[1::2])
 
         return res_ir_reg
 
@@ -1264,9 +1424,7 @@ def generate_ir(generator, node):
         for (arg_ir_ref, arg_ir_reg, arg_type), parameter in zip(arg_ir_ref_reg_types, fn.parameters):
             # Convert each argument to the parameter type
             
-            # XXX Converting the type to str easily deals with comparing complex
-            #     types, but it's hacky, change to a proper deep comparison?
-            if (str(arg_type) != str(parameter.value_type)):
+            if (not type_equals(arg_type, parameter.value_type)):
                 # If parameter is a pointer and argument is a compatible array,
                 # lower to  pointer with a magic 0, 0 index getelementptr
                 if (
@@ -1277,7 +1435,7 @@ def generate_ir(generator, node):
                         # same element type
                         (parameter.value_type[0] == arg_type[0])
                     ):
-                    inds = [ir.IntType(32)(0), ir.IntType(32)(0)]
+                    inds = [ir_i32_0, ir_i32_0]
                     arg_ir_reg = generator.llvmir.builder.gep(arg_ir_ref, inds, True)
 
                 else:
@@ -1305,20 +1463,24 @@ def generate_ir(generator, node):
         return a_ir_reg
 
     def generate_save_stack_ir(generator):
-        # XXX A lot of this could be cached
-        pint8 = ir.IntType(8).as_pointer()
-        stacksave_ir_type = ir.FunctionType(pint8, [])
-        stacksave_fn_ir = generator.llvmir.module.declare_intrinsic("llvm.stacksave", fnty=stacksave_ir_type) 
-        stack_ir_reg = generator.llvmir.builder.call(stacksave_fn_ir, []) 
+        # Declare the intrinsic once per module and cache it, rebuilding the
+        # function type and redeclaring on every save was wasted work
+        stacksave_fn_ir = generator.llvmir.stacksave_fn_ir
+        if (stacksave_fn_ir is None):
+            stacksave_ir_type = ir.FunctionType(ir_pi8, [])
+            stacksave_fn_ir = generator.llvmir.module.declare_intrinsic("llvm.stacksave", fnty=stacksave_ir_type)
+            generator.llvmir.stacksave_fn_ir = stacksave_fn_ir
+        stack_ir_reg = generator.llvmir.builder.call(stacksave_fn_ir, [])
 
         return stack_ir_reg
 
     def generate_restore_stack_ir(generator):
-        # XXX A lot of this could be cached
         if (generator.llvmir.stack_ir_reg is not None):
-            pint8 = ir.IntType(8).as_pointer()
-            stackrestore_ir_type = ir.FunctionType(ir.VoidType(), [pint8])
-            stackrestore_fn_ir = generator.llvmir.module.declare_intrinsic("llvm.stackrestore", fnty=stackrestore_ir_type)
+            stackrestore_fn_ir = generator.llvmir.stackrestore_fn_ir
+            if (stackrestore_fn_ir is None):
+                stackrestore_ir_type = ir.FunctionType(ir_void, [ir_pi8])
+                stackrestore_fn_ir = generator.llvmir.module.declare_intrinsic("llvm.stackrestore", fnty=stackrestore_ir_type)
+                generator.llvmir.stackrestore_fn_ir = stackrestore_fn_ir
             generator.llvmir.builder.call(stackrestore_fn_ir, [generator.llvmir.stack_ir_reg])
 
 
@@ -1337,7 +1499,7 @@ def generate_ir(generator, node):
 
         generator.llvmir.builder.store(b_ir_reg, a_ir_ref)
 
-        gen_node = Struct(type="ir", value_type=res_type, ir_reg=res_ir_reg)
+        gen_node = Struct(type="ir", value_type=res_type, ir_reg=res_ir_reg, ir_ref=None)
 
         return gen_node
 
@@ -1374,7 +1536,7 @@ def generate_ir(generator, node):
         res_ir_reg = generate_extern_call_ir(generator, fn_name, res_type, 
             [res_type, a_ir_reg, res_type, b_ir_reg])
 
-        gen_node = Struct(type="ir", value_type=res_type, ir_reg=res_ir_reg)
+        gen_node = Struct(type="ir", value_type=res_type, ir_reg=res_ir_reg, ir_ref=None)
 
         return gen_node
 
@@ -1390,19 +1552,23 @@ def generate_ir(generator, node):
         gen_node = generate_assign_ir(generator, a, b)
 
         if (post):
-            gen_node = Struct(type="ir", value_type=a_type, ir_reg=a_ir_reg)
+            gen_node = Struct(type="ir", value_type=a_type, ir_reg=a_ir_reg, ir_ref=None)
 
         return gen_node
 
 
     gen_node = None
     generator.depth += 1
-    debug = (__name__ == "__main__")
+    debug = debug_prints
     
     # Node can be Token or Tree
     if (type(node) is lark.Tree):
+        # Bind the node attributes once, the dispatch chain below reads them
+        # many times per node
+        data = node.data
+        children = node.children
         if (debug):
-            print "  " * generator.depth, "enter", node.data
+            print "  " * generator.depth, "enter", data
         # XXX When there's more than one child we need to special case some
         #     of the rules so we avoid returning too much nesting or long
         #     lists that make things down the line  harder or
@@ -1411,7 +1577,7 @@ def generate_ir(generator, node):
         #     Is there a better way with some automated whitelist or lark 
         #     facility that doesn't require touching the .lark file? or 
         #     maybe it could be massaged at load time?
-        if (node.data == "compound_statement"):
+        if (data == "compound_statement"):
             # compound_statement:  "{" block_item_list? "}"
 
             generator.symbol_table.push_scope()
@@ -1419,7 +1585,7 @@ def generate_ir(generator, node):
             stack_ir_reg = generator.llvmir.stack_ir_reg
             generator.llvmir.stack_ir_reg = None
     
-            gen_node = generate_ir(generator, node.children[1])
+            gen_node = generate_ir(generator, children[1])
 
             # If this scope stashed a stack register, restore the sack, since 
             # the scope is gone no code will access whatever variable caused
@@ -1431,17 +1597,83 @@ def generate_ir(generator, node):
             
             generator.symbol_table.pop_scope()
 
-        elif (node.data == "argument_expression_list"):
+        # Constants and identifiers are the most common leaf nodes,
+        # dispatch them early in the chain
+        elif (data == "integer_constant"):
+            # XXX Check non decimal encoding (hex, oct)
+            lexeme = children[0]
+            gen_node = integer_constant_cache.get(lexeme, None)
+            if (gen_node is None):
+                value = lexeme
+                # Strip the suffix characters, at most three, and get the type
+                # from the precomputed table (hex digits never collide with
+                # suffix characters so scanning backwards is safe)
+                suffix_start = len(value)
+                while ((suffix_start > 0) and (value[suffix_start - 1] in "uUlL")):
+                    suffix_start -= 1
+                value_type = integer_suffix_types[value[suffix_start:].upper()]
+                # Pass the base explicitly so int() doesn't re-scan for it
+                if (value.startswith("0x") or value.startswith("0X")):
+                    base = 16
+                elif ((value[0] == "0") and (suffix_start > 1)):
+                    base = 8
+                else:
+                    base = 10
+                value = int(value[:suffix_start], base)
+                
+                gen_node = Struct(type="constant", value_type=value_type, value=value)
+                integer_constant_cache[lexeme] = gen_node
+
+        elif (data == "floating_constant"):
+            lexeme = children[0].value
+            gen_node = floating_constant_cache.get(lexeme, None)
+            if (gen_node is None):
+                float_type = "double"
+                value = lexeme
+                if (value[-1] in ["f", "F"]):
+                    float_type = "float"
+
+                if (value[-1] in ["f", "F", "L", "l"]):
+                    value = value[:-1]
+
+                if (value.startswith("0x")):
+                    value = float.fromhex(value)
+
+                else:
+                    value = float(value)
+
+                gen_node = Struct(type="constant", value_type = float_type, value= value)
+                floating_constant_cache[lexeme] = gen_node
+
+        elif ((data == "character_constant") or (data == "string_literal")):
+            # XXX Needs handling of the escape cases, encodings, etc
+            #     octal-escape-sequence
+            #     hexadecimal-escape-sequence
+            #     universal-character-name
+            # simple_escape_sequence: "\\'" | "\\\"" | "\\?" | "\\" | "\\a" | "\\b" | "\\f" | "\\n" | "\\r" | "\\t" | "\\v"
+
+            assert False, "character_constant / string_literal not supported yet!"
+
+
+        elif (data == "identifier"):
+            gen_node = Struct(type="identifier", value=children[0].value, dims=None)
+
+        elif (data == "argument_expression_list"):
             # argument_expression_list:  assignment_expression
             # |  argument_expression_list "," assignment_expression
             # XXX Should unify all the _list?
-            if (len(node.children) == 1):
-                gen_node = [generate_ir(generator, node.children[0])]
-            else:
-                gen_node = generate_ir(generator, node.children[0])
-                gen_node.append(generate_ir(generator, node.children[2]))
-
-        elif (node.data == "postfix_expression"):
+            # Descend the left-recursive chain iteratively so long argument
+            # lists don't recurse once per argument, then generate in
+            # left-to-right argument order
+            arg_nodes = []
+            list_node = node
+            while (len(list_node.children) > 1):
+                arg_nodes.append(list_node.children[2])
+                list_node = list_node.children[0]
+            arg_nodes.append(list_node.children[0])
+            gen_node = [generate_ir(generator, arg_node) for arg_node in reversed(arg_nodes)]
+
+        elif (data == "postfix_expression"):
             # postfix_expression:  primary_expression
             # |  postfix_expression "[" expression "]"
             # |  postfix_expression "(" argument_expression_list? ")"
@@ -1452,20 +1684,20 @@ def generate_ir(generator, node):
             # |  "(" type_name ")" "{" initializer_list "}"
             # |  "(" type_name ")" "{" initializer_list "," "}"
 
-            if (node.children[0].data == "primary_expression"):
-                gen_node = generate_ir(generator, node.children[0])
+            if (children[0].data == "primary_expression"):
+                gen_node = generate_ir(generator, children[0])
 
-            elif (node.children[1] in ["++", "--"]):
+            elif (children[1] in incr_ops):
                 # Perform new_a = old_a +- 1, return old_a
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
                 
-                op_sign = node.children[1][0]
+                op_sign = children[1][0]
                 gen_node = generate_incr_ir(generator, gen_node, op_sign, True)
 
-            elif (node.children[1] == "("):
+            elif (children[1] == "("):
                 # |  postfix_expression "(" argument_expression_list? ")"
                 # Function call
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
                 # XXX This only supports straight identifiers, no function pointer
                 #     expressions
                 assert (gen_node.type == "identifier")
@@ -1473,15 +1705,15 @@ def generate_ir(generator, node):
                 fn_name = gen_node.value
                 
                 arg_ir_ref_reg_types = []
-                if (node.children[2] != ")"):
+                if (children[2] != ")"):
                     # Collect parameters
-                    gen_node = generate_ir(generator, node.children[2])
+                    gen_node = generate_ir(generator, children[2])
                     arg_ir_ref_reg_types = [get_ir_ref_reg_and_type(a) for a in gen_node]
 
                 res_ir_reg, res_type = generate_call_ir(generator, fn_name, arg_ir_ref_reg_types)
-                gen_node = Struct(type="ir", value_type=res_type, ir_reg=res_ir_reg)
+                gen_node = Struct(type="ir", value_type=res_type, ir_reg=res_ir_reg, ir_ref=None)
 
-            elif (node.children[1] == "["):
+            elif (children[1] == "["):
                 def get_array_item_type(t):
                     if (isinstance(t[0], list)):
                         res = get_array_item_type(t[0])
@@ -1489,7 +1721,7 @@ def generate_ir(generator, node):
                         res = t[0]
 
                 # |  postfix_expression "[" expression "]"
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
                 assert(isinstance(gen_node, Struct))
 
                 # There are three ways of using getelementptr (gep)
@@ -1528,8 +1760,9 @@ def generate_ir(generator, node):
                 #  %12 = getelementptr inbounds i32, i32* %11, i64 1, !dbg !27
                 
                 ir_ref, ir_reg, a_type = get_ir_ref_reg_and_type(gen_node)
+                builder = generator.llvmir.builder
                 
-                ind = generate_ir(generator, node.children[2])
+                ind = generate_ir(generator, children[2])
 
                 # Convert index to 64-bit if necessary
                 # XXX Should use something more abstract like size_t
@@ -1544,11 +1777,11 @@ def generate_ir(generator, node):
     
                     if (a_type[1] is None):
                         # Pointer, use ir_reg and don't 0 dereference
-                        ptr = generator.llvmir.builder.gep(ir_reg, [ind_ir_reg], True)
+                        ptr = builder.gep(ir_reg, [ind_ir_reg], True)
 
                     else:
                         # Array, use ir_ref and 0 dereference
-                        ptr = generator.llvmir.builder.gep(ir_ref, [ir.IntType(32)(0)] + [ind_ir_reg], True)
+                        ptr = builder.gep(ir_ref, [ir_i32_0, ind_ir_reg], True)
 
                 else:
                     # Dimensions are not known at compile time, work out the
@@ -1569,67 +1802,67 @@ def generate_ir(generator, node):
                         #     optimizer removes any redundant calculations, so
                         #     it's low priority)
                         dim_ir_reg = generate_type_conversion_ir(generator, dim, size_t_type)
-                        ind_ir_reg = generator.llvmir.builder.mul(ind_ir_reg, dim_ir_reg)
+                        ind_ir_reg = builder.mul(ind_ir_reg, dim_ir_reg)
                     
                     if (a_type[1] is None):
                         # Pointer, use ir_reg
-                        ptr = generator.llvmir.builder.gep(ir_reg, [ind_ir_reg], True)
+                        ptr = builder.gep(ir_reg, [ind_ir_reg], True)
 
                     else:
                         # Array, use ir_ref
-                        ptr = generator.llvmir.builder.gep(ir_ref, [ind_ir_reg], True)
+                        ptr = builder.gep(ir_ref, [ind_ir_reg], True)
                     
                 # XXX This load is overkill since most of the time this is
                 #     generated for partial indexing which is thrown away, can
                 #     it be delayed? (not a big deal since the optimizer removes
                 #     it anyway)
-                ir_reg = generator.llvmir.builder.load(ptr)
+                ir_reg = builder.load(ptr)
                 # Lower the C type by removing the last dimension
                 gen_node = Struct(type="ir", value_type=a_type[0], ir_reg=ir_reg, ir_ref=ptr)
 
-            elif (node.children[0].data == "postfix_expression"):
+            elif (children[0].data == "postfix_expression"):
                 # |  postfix_expression "." identifier
-                gen_node = generate_ir(generator, node.children[0])
-                identifier = generate_ir(generator, node.children[2])
+                gen_node = generate_ir(generator, children[0])
+                identifier = generate_ir(generator, children[2])
 
                 ir_ref, ir_reg, a_type = get_ir_ref_reg_and_type(gen_node)
+                builder = generator.llvmir.builder
 
                 assert(type_is_struct_or_union(a_type))
 
-                field_index = a_type.keys().index(identifier.value)
-                field_name = a_type.keys()[field_index]
-                ptr = generator.llvmir.builder.gep(ir_ref, [ir.IntType(32)(0), ir.IntType(32)(field_index)], True)
+                field_index = a_type.field_indices[identifier.value]
+                ptr = builder.gep(ir_ref, [ir_i32_0, ir_i32(field_index)], True)
                 # XXX Generating this is probably overkill most of the time
-                ir_reg = generator.llvmir.builder.load(ptr)
+                ir_reg = builder.load(ptr)
 
                 # Lower the type to the field type
-                gen_node = Struct(type="ir", value_type=a_type[field_name], ir_reg=ir_reg, ir_ref=ptr)
+                gen_node = Struct(type="ir", value_type=a_type[identifier.value], ir_reg=ir_reg, ir_ref=ptr)
 
             else:
                 # XXX Support the rest of postfix_expression
                 assert False, "Unhandled postfix_expression %s" % node
 
-        elif (node.data == "unary_expression"):
+        elif (data == "unary_expression"):
             # unary_expression:  postfix_expression
             # |  "++" unary_expression
             # |  "--" unary_expression
             # |  unary_operator cast_expression
             # |  "sizeof" unary_expression
             # |  "sizeof" "(" type_name ")"
-            if (len(node.children) == 1):
-                gen_node = generate_ir(generator, node.children[0])
+            if (len(children) == 1):
+                gen_node = generate_ir(generator, children[0])
 
-            elif (node.children[0] in ["++", "--"]):
+            elif (children[0] in incr_ops):
                 # perform new_a = old_a +- 1, return new_a
-                gen_node = generate_ir(generator, node.children[1])
+                gen_node = generate_ir(generator, children[1])
 
-                op_sign = node.children[0][1]
+                op_sign = children[0][1]
                 gen_node = generate_incr_ir(generator, gen_node, op_sign, False)
                 
             else:
                 assert False, "Unsupported unary_expression %s" % repr(node)
             
-        elif (node.data == "cast_expression"):
+        elif (data == "cast_expression"):
             # cast_expression:  unary_expression
             #  |  "(" type_name ")" cast_expression
             
@@ -1638,22 +1871,24 @@ def generate_ir(generator, node):
             # This takes care of not pushing constants and identifiers up
             # XXX This could be done earlier in primary_expression
             # XXX This may make harder detecting constants upstream?
-            if (len(node.children) > 1):
+            if (len(children) > 1):
                 gen_node = [
-                    generate_ir(generator, node.children[1]),
-                    generate_ir(generator, node.children[3])
+                    generate_ir(generator, children[1]),
+                    generate_ir(generator, children[3])
                 ]
                 # There's a cast operator, deal with it
                 res_type = gen_node[0]
                 gen_node = gen_node[1]
 
             else:
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
                 res_type = None
 
             a_ir_ref, a_ir_reg, a_type = get_ir_ref_reg_and_type(gen_node)
             
-            if ((res_type is not None) and (res_type != a_type)):
+            # Identity short-circuits the deep comparison arrays and structs
+            # would otherwise do on every no-op cast
+            if ((res_type is not None) and (res_type is not a_type) and (res_type != a_type)):
                 res_ir_reg = generate_extern_call_ir(generator, 
                     get_fn_name("cnv", res_type, a_type), res_type, [a_type, a_ir_reg])
                 res_ir_ref = None
@@ -1665,18 +1900,18 @@ def generate_ir(generator, node):
 
             gen_node = Struct(type="ir", value_type=res_type, ir_reg=res_ir_reg, ir_ref=res_ir_ref)
 
-        elif (node.data == "primary_expression"):
+        elif (data == "primary_expression"):
             # primary_expression:  identifier
             #   |  constant
             #   |  string_literal
             #   |  "(" expression ")"
 
-            if (len(node.children) > 1):
-                gen_node = generate_ir(generator, node.children[1])
+            if (len(children) > 1):
+                gen_node = generate_ir(generator, children[1])
             else:
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
             
-        elif (node.data.endswith("_expression") and (len(node.children) == 3)):
+        elif (data.endswith("_expression") and (len(children) == 3)):
             # Cach all two operands + sign expressions
 
             # assignment_expression:  conditional_expression
@@ -1690,15 +1925,16 @@ def generate_ir(generator, node):
             #   |  multiplicative_expression "%" cast_expression
             
             a, op_sign, b = (
-                generate_ir(generator, node.children[0]),
-                generate_ir(generator, node.children[1]),
-                generate_ir(generator, node.children[2]),
+                generate_ir(generator, children[0]),
+                generate_ir(generator, children[1]),
+                generate_ir(generator, children[2]),
             )
 
             if (op_sign in ass_ops):
-                if (len(op_sign) > 1):
+                binop_sign = compound_to_binop_sign.get(op_sign, None)
+                if (binop_sign is not None):
                     # assing + operation, generate "a += b" as "a = a + b"
-                    b = generate_binop_ir(generator, a, b, op_sign[:-1])
+                    b = generate_binop_ir(generator, a, b, binop_sign)
                     
                 gen_node = generate_assign_ir(generator, a, b)
                 
@@ -1706,28 +1942,28 @@ def generate_ir(generator, node):
 
                 gen_node = generate_binop_ir(generator, a, b, op_sign)
 
-        elif (node.data == "expression"):
+        elif (data == "expression"):
             # expression:  assignment_expression
             #   |  expression "," assignment_expression
-            if (len(node.children) == 1):
-                gen_node = generate_ir(generator, node.children[0])
+            if (len(children) == 1):
+                gen_node = generate_ir(generator, children[0])
 
             else:
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
                 # Last expression is the value of the assignment expression
-                gen_node = generate_ir(generator, node.children[2])
+                gen_node = generate_ir(generator, children[2])
 
-        elif (node.data == "expression_statement"):
+        elif (data == "expression_statement"):
             # expression_statement:  expression? ";"
-            if (len(node.children) > 1):
-                gen_node = generate_ir(generator, node.children[0])
+            if (len(children) > 1):
+                gen_node = generate_ir(generator, children[0])
 
-        elif (node.data == "jump_statement"):
+        elif (data == "jump_statement"):
             # jump_statement:  "goto" identifier ";"
             #     |  "continue" ";"
             #     |  "break" ";"
             #     |  "return" expression? ";"
-            if (node.children[0].value == "return"):
+            if (children[0].value == "return"):
                 # Note there's no need to restore the stack register on return
                 # since there could be multiple of them stacked and the stack
                 # is cleaned up by return anyway
@@ -1738,18 +1974,18 @@ def generate_ir(generator, node):
                 fn = generator.symbol_table[function_name]
                     
                 if (fn.value_type == "void"):
-                    assert (len(node.children) == 2)
+                    assert (len(children) == 2)
                     generator.llvmir.builder.ret_void()
 
                 else:
-                    gen_node = generate_ir(generator, node.children[1])
+                    gen_node = generate_ir(generator, children[1])
                     res_ir_reg = gen_node.ir_reg
                     res_type = gen_node.value_type
 
                     # If the return type is different from the expression,
                     # convert
                     if (fn.value_type != res_type):
-                        assert (len(node.children) == 3)
+                        assert (len(children) == 3)
                         
                         a_type = res_type
                         a_ir_reg = res_ir_reg
@@ -1761,13 +1997,13 @@ def generate_ir(generator, node):
                 
                 goto_unreachable_block()
                 
-            elif (node.children[0].value == "break"):
+            elif (children[0].value == "break"):
                 generate_restore_stack_ir(generator)
 
                 generate_branch_ir(generator.llvmir.break_bb)
                 goto_unreachable_block()
                 
-            elif (node.children[0].value == "continue"):
+            elif (children[0].value == "continue"):
                 generate_restore_stack_ir(generator)
 
                 generate_branch_ir(generator.llvmir.continue_bb)
@@ -1779,19 +2015,19 @@ def generate_ir(generator, node):
 
             # XXX Null gen_node in this and others?
 
-        elif (node.data == "init_declarator_list"):
+        elif (data == "init_declarator_list"):
             # init_declarator_list:  init_declarator
             # |  init_declarator_list "," init_declarator 
             # Skip the commas, pass the rest
             
-            if (len(node.children) == 1):
-                gen_node = [generate_ir(generator, node.children[0])]
+            if (len(children) == 1):
+                gen_node = [generate_ir(generator, children[0])]
 
             else:
-                gen_node = generate_ir(generator, node.children[0])
-                gen_node.append(generate_ir(generator, node.children[2]))
+                gen_node = generate_ir(generator, children[0])
+                gen_node.append(generate_ir(generator, children[2]))
 
-        elif (node.data == "function_definition"):
+        elif (data == "function_definition"):
             # function_definition:  declaration_specifiers declarator declaration_list? compound_statement
             # function_definition
             #   declaration_specifiers
@@ -1811,12 +2047,12 @@ def generate_ir(generator, node):
             # body needs it eg because calls it recursively
             
             # Read return type
-            function_type = generate_ir(generator, node.children[0])
+            function_type = generate_ir(generator, children[0])
             # XXX Missing dealing with inline, const, etc
             function_type = get_canonical_type(function_type)
             
             # Read name and parameters
-            gen_node = generate_ir(generator, node.children[1])
+            gen_node = generate_ir(generator, children[1])
             function_name = gen_node[0].value
 
             fn = generator.symbol_table.get(function_name, None)
@@ -1842,7 +2078,8 @@ def generate_ir(generator, node):
             # them in the overflow symbol table
             for parameter, arg in zip(fn.parameters, fn.ir.args):
                 parameter.ir_reg = arg
-                generator.symbol_table.set_overflow_item(parameter.name, parameter)
+            generator.symbol_table.set_overflow_items(
+                (parameter.name, parameter) for parameter in fn.parameters)
 
             generator.llvmir.function = fn.ir
 
@@ -1852,7 +2089,7 @@ def generate_ir(generator, node):
             generator.llvmir.builder = ir.IRBuilder(block)
 
             # Generate the function's body
-            gen_node = generate_ir(generator, node.children[-1])
+            gen_node = generate_ir(generator, children[-1])
 
             # The current block won't be terminated either because 
             # - it's the unreacheable block placed after every return
@@ -1868,46 +2105,49 @@ def generate_ir(generator, node):
             else:
                 generator.llvmir.builder.ret(get_llvmlite_type(fn.value_type)(ir.Undefined))
             
-            fn.llvm_irs = str(generator.llvmir.function).splitlines()
+            # Keep the function IR as a single chunk, epycc_generate joins
+            # the chunks with newlines anyway so splitting into lines here
+            # would just copy the whole text a second time
+            fn.llvm_irs = [str(generator.llvmir.function).rstrip("\n")]
             do_reindexing = False
             if (do_reindexing):
-                fn.llvm_irs = convert_to_clang_irs(fn.llvm_irs)
+                fn.llvm_irs = convert_to_clang_irs(fn.llvm_irs[0].splitlines())
 
             gen_node = generator.symbol_table[function_name]
 
             generator.function = None
 
-        elif (node.data == "identifier_list"):
+        elif (data == "identifier_list"):
             # identifier_list:  identifier
             #   |  identifier_list "," identifier
-            if (len(node.children) > 1):
-                gen_node = generate_ir(generator, node.children[0])
-                gen_node.append(generate_ir(generator, node.children[2]))
+            if (len(children) > 1):
+                gen_node = generate_ir(generator, children[0])
+                gen_node.append(generate_ir(generator, children[2]))
             else:
-                gen_node = [generate_ir(generator, node.children[0])]
+                gen_node = [generate_ir(generator, children[0])]
 
 
-        elif (node.data == "parameter_list"):
+        elif (data == "parameter_list"):
             # parameter_list:  parameter_declaration 
             #   |  parameter_list "," parameter_declaration
             # Remove extra nesting so the parameter list location is
             # deterministic at parameter collection time in the function
             # wrap-up
             
-            if (len(node.children) > 1):
-                gen_node = generate_ir(generator, node.children[0])
-                gen_node.append(generate_ir(generator, node.children[2]))
+            if (len(children) > 1):
+                gen_node = generate_ir(generator, children[0])
+                gen_node.append(generate_ir(generator, children[2]))
                  
             else:
-                gen_node = [generate_ir(generator, node.children[0])]
+                gen_node = [generate_ir(generator, children[0])]
                 
 
-        elif (node.data == "parameter_declaration"):
+        elif (data == "parameter_declaration"):
             # parameter_declaration:  declaration_specifiers declarator
             # |  declaration_specifiers abstract_declarator?
             
             gen_node = []
-            for child in node.children:
+            for child in children:
                 gen_node.append(generate_ir(generator, child))
 
             parameter_name = None
@@ -1935,30 +2175,33 @@ def generate_ir(generator, node):
                 type="parameter", 
                 name=parameter_name, 
                 value_type=parameter_type, 
+                # Ir_reg and ir_ref will be assigned on usage
+                ir_reg=None,
+                ir_ref=None,
             )
             
             gen_node = parameter
                             
 
-        elif (node.data == "init_declarator"):
+        elif (data == "init_declarator"):
             # declarator contains one identifier and one or none initializers
             # init_declarator:  declarator
             # |  declarator "=" initializer
-            identifier = generate_ir(generator, node.children[0])
-            #identifier = get_tree_tokens(node.children[0])[0]
+            identifier = generate_ir(generator, children[0])
+            #identifier = get_tree_tokens(children[0])[0]
             initializer = None
-            if (len(node.children) > 1):
-                initializer = generate_ir(generator, node.children[2])
+            if (len(children) > 1):
+                initializer = generate_ir(generator, children[2])
             
             gen_node = [identifier, initializer]
 
-        elif (node.data == "declaration"):
+        elif (data == "declaration"):
             # declaration:  declaration_specifiers init_declarator_list? ";"
 
             # declaration contains one type and one or more identifiers and or
             # initializerss
 
-            decl_type = generate_ir(generator, node.children[0])
+            decl_type = generate_ir(generator, children[0])
             # XXX Missing dealing with inline, const, etc
             decl_type = get_canonical_type(decl_type)
 
@@ -1968,7 +2211,7 @@ def generate_ir(generator, node):
                 # XXX Only forward function declarations are supported, global
                 #     variables are not
                 assert (
-                    (len(node.children) > 1) and 
+                    (len(children) > 1) and 
                     (get_grandson(node, [1, 0, 0, 0, 1]).value == "(")
                 ), "Only function forward declarations supported!!!"
                 
@@ -1976,7 +2219,7 @@ def generate_ir(generator, node):
                 # Gather the function parameters
                 # XXX This has some unnecessary nesting, find the culprit and
                 #     flatten it?
-                gen_node = generate_ir(generator, node.children[1])
+                gen_node = generate_ir(generator, children[1])
                 function_name = gen_node[0][0][0].value
                 # LLVM only allows declaring functions once, ignore if already
                 # declared
@@ -1993,8 +2236,8 @@ def generate_ir(generator, node):
                 
                 # The declarator list may contain initializer so we cannot
                 # just snoop whatever data, it needs generating
-                if (len(node.children) > 1):
-                    gen_node = generate_ir(generator, node.children[1])
+                if (len(children) > 1):
+                    gen_node = generate_ir(generator, children[1])
                     
                 # Register the variable and create an IR node to hold the
                 # initializer, if any
@@ -2007,7 +2250,9 @@ def generate_ir(generator, node):
                         type="variable", 
                         name=identifier.value, 
                         value_type=decl_type,
-                        # Value_reg and value_ref will be assigned on usage
+                        # Ir_reg and ir_ref will be assigned on usage
+                        ir_reg=None,
+                        ir_ref=None,
                     )
                     generator.symbol_table[identifier.value] = variable
                     
@@ -2016,14 +2261,14 @@ def generate_ir(generator, node):
                         assert(isinstance(initializer, Struct) and (initializer.type == "ir"))
                         generate_assign_ir(generator, identifier, initializer)
                         
-            gen_node = Struct(type="ir", value_type="void", ir_reg=None)
+            gen_node = Struct(type="ir", value_type="void", ir_reg=None, ir_ref=None)
 
-        elif (node.data == "struct_or_union_specifier"):
+        elif (data == "struct_or_union_specifier"):
             # struct_or_union_specifier:  struct_or_union identifier? "{" struct_declaration_list "}"
             # |  struct_or_union identifier
             
             # Struct definition
-            if (len(node.children) > 2):
+            if (len(children) > 2):
                 if (get_grandson(node, [0, 0]) == "struct"):
                     # Struct
                     d = odict()
@@ -2035,9 +2280,9 @@ def generate_ir(generator, node):
                     d = dict()
                 
                 # XXX Handle identifier after struct_or_union
-                assert len(node.children) == 4, "Struct declaration not supported!!"
+                assert len(children) == 4, "Struct declaration not supported!!"
 
-                item_type_identifiers = generate_ir(generator, node.children[-2])
+                item_type_identifiers = generate_ir(generator, children[-2])
                 # This returns a list of c type and name or names
                 assert(isinstance(item_type_identifiers, list) and isinstance(item_type_identifiers[0], list))
                 d = odict()
@@ -2046,39 +2291,43 @@ def generate_ir(generator, node):
                         field_type = build_type_from_dimensions(item_type, identifier.dims)
                         d[identifier.value] = field_type
 
+                # Stash the field name to index mapping on the type so field
+                # accesses don't have to rebuild keys() and linearly scan it
+                d.field_indices = dict((name, i) for i, name in enumerate(d))
+
                 return d
 
             else:
                 assert False, "Struct declaration not supported!!"
 
-        elif (node.data == "struct_declaration_list"):
+        elif (data == "struct_declaration_list"):
             # struct_declaration_list:  struct_declaration
             # |  struct_declaration_list struct_declaration
             # XXX Should unify all the _list? (note this list has no separator)
-            if (len(node.children) == 1):
-                gen_node = [generate_ir(generator, node.children[0])]
+            if (len(children) == 1):
+                gen_node = [generate_ir(generator, children[0])]
             else:
-                gen_node = generate_ir(generator, node.children[0])
-                gen_node.append(generate_ir(generator, node.children[1]))
+                gen_node = generate_ir(generator, children[0])
+                gen_node.append(generate_ir(generator, children[1]))
 
-        elif (node == "specifier_qualifier_list"):
+        elif (data == "specifier_qualifier_list"):
             # specifier_qualifier_list:  type_specifier specifier_qualifier_list?
             # |  type_qualifier specifier_qualifier_list?
             # XXX Should unify all the _list= (note this is right recursive)
 
-            gen_node = generate_ir(generator, node.children[0])
+            gen_node = generate_ir(generator, children[0])
             # The type can be a str for a basic type/typedef or an odict for
             # struct
             assert isinstance(gen_node, (str, odict)), "Expected str, odict, found %s" % gen_node
             gen_node = [gen_node]
-            if (len(node.children) > 1):
-                gen_node.extend(generate_ir(generator, node.children[1]))
+            if (len(children) > 1):
+                gen_node.extend(generate_ir(generator, children[1]))
 
-        elif (node.data == "struct_declaration"):
+        elif (data == "struct_declaration"):
             # struct_declaration:  specifier_qualifier_list struct_declarator_list ";"
 
             # Collect into pair type, names and bubble up
-            res_type = generate_ir(generator, node.children[0])
+            res_type = generate_ir(generator, children[0])
             # We expect a list of strings or a single element list of complex types
             # XXX Missing dealing with inline, const, etc
             assert isinstance(res_type, list), "Expected list, found %s" % res_type
@@ -2086,27 +2335,27 @@ def generate_ir(generator, node):
             # Unbox/canonicalize the types
             if (isinstance(res_type[0], str)):
                 # Join all specifiers plus type a canonical type
-                res_type = string.join(res_type, " ")
+                res_type = " ".join(res_type)
                 res_type = get_canonical_type(res_type)
 
             else:
                 res_type = res_type[0]
 
-            res_names = generate_ir(generator, node.children[1])
+            res_names = generate_ir(generator, children[1])
 
             gen_node = [res_type, res_names]
 
-        elif (node.data == "struct_declarator_list"):
+        elif (data == "struct_declarator_list"):
             # struct_declarator_list:  struct_declarator
             # |  struct_declarator_list "," struct_declarator
             # XXX Should unify all the _list?
-            if (len(node.children) == 1):
-                gen_node = [generate_ir(generator, node.children[0])]
+            if (len(children) == 1):
+                gen_node = [generate_ir(generator, children[0])]
             else:
-                gen_node = generate_ir(generator, node.children[0])
-                gen_node.append(generate_ir(generator, node.children[2]))
+                gen_node = generate_ir(generator, children[0])
+                gen_node.append(generate_ir(generator, children[2]))
 
-        elif (node.data == "direct_declarator"):
+        elif (data == "direct_declarator"):
             # direct_declarator:  identifier
             # |  "(" declarator ")"
             # |  direct_declarator "[" type_qualifier_list? assignment_expression? "]"
@@ -2117,23 +2366,23 @@ def generate_ir(generator, node):
             # |  direct_declarator "(" identifier_list? ")"
             
             # Flatten and push up left recursive lists
-            if (node.children[0].data == "identifier"):
-                gen_node = generate_ir(generator, node.children[0])
+            if (children[0].data == "identifier"):
+                gen_node = generate_ir(generator, children[0])
 
-            elif (node.children[1].value == "("):
+            elif (children[1].value == "("):
                 # Function declarations, including empty and prototypes
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
 
-                if (len(node.children) > 3):
+                if (len(children) > 3):
                     # Gather identifier_list or parameter_type_list
                     assert isinstance(gen_node, str) or isinstance(gen_node, Struct)
-                    gen_node = [gen_node] + [generate_ir(generator, node.children[2])]
+                    gen_node = [gen_node] + [generate_ir(generator, children[2])]
 
                 else:
                     gen_node = [gen_node]
 
-            elif ((node.children[0].data == "direct_declarator") and 
-                  (node.children[1].value == "[")):
+            elif ((children[0].data == "direct_declarator") and 
+                  (children[1].value == "[")):
                 # |  direct_declarator "[" type_qualifier_list? assignment_expression? "]"
                 # |  direct_declarator "[" "static" type_qualifier_list? assignment_expression "]"
                 # |  direct_declarator "[" type_qualifier_list "static" assignment_expression "]"
@@ -2143,19 +2392,19 @@ def generate_ir(generator, node):
                 # identifier with dims field with dimensions which can be None
                 # (no dimensions), or an ir (which can be constant or not)
                 
-                gen_node = generate_ir(generator, node.children[0])
+                gen_node = generate_ir(generator, children[0])
                 assert isinstance(gen_node, str) or isinstance(gen_node, Struct)
-                if (len(node.children) == 3):
+                if (len(children) == 3):
                     # Unsized array, return None dimensions
                     dim = None
 
                 else:
                     # XXX No support for qualified arrays yet
-                    assert (node.children[-2].data == "assignment_expression")
+                    assert (children[-2].data == "assignment_expression")
                     # XXX The expression handler could have some minimal compile
                     #     time constant folding to avoid creating runtime arrays
                     #     when using simple constant expressions
-                    dim = generate_ir(generator, node.children[-2])
+                    dim = generate_ir(generator, children[-2])
                     
                     
                 if (gen_node.dims is None):
@@ -2166,90 +2415,37 @@ def generate_ir(generator, node):
             else:
                 assert False, "Unhandled direct_declarator"
 
-        elif (node.data == "block_item_list"):
+        elif (data == "block_item_list"):
             # block_item_list:  block_item
             # |  block_item_list block_item
 
             # The code is accumulated in the builder, just return the last block
             # in the list
-            gen_node = generate_ir(generator, node.children[0])
-            if (len(node.children) > 1):
-                gen_node = generate_ir(generator, node.children[1])
+            gen_node = generate_ir(generator, children[0])
+            if (len(children) > 1):
+                gen_node = generate_ir(generator, children[1])
                 
             
-        elif (node.data == "integer_constant"):
-            # XXX Check non decimal encoding (hex, oct)
-            value = node.children[0]
-            value_type = "int"
-            # Conservative suffix, may be smaller
-            suffix = value[-3:].upper()
-            value_len = len(value)
-            # Check type suffixes
-            if ("LL" in suffix):
-                value_type = "long long"
-                value_len -= 2
-            elif ("L" in suffix):
-                # Note LL was checked before, so checking one L here is safe
-                value_type = "long"
-                value_len -= 1
-            # Check sign suffix
-            if ("U" in suffix):
-                value_type = "unsigned " + value_type
-                value_len -= 1
-            value = int(value[:value_len], 0)
-            
-            gen_node = Struct(type="constant", value_type=value_type, value=value)
-
-        elif (node.data == "floating_constant"):
-            float_type = "double"
-            value = node.children[0].value
-            if (value[-1] in ["f", "F"]):
-                float_type = "float"
-
-            if (value[-1] in ["f", "F", "L", "l"]):
-                value = value[:-1]
-
-            if (value.startswith("0x")):
-                value = float.fromhex(value)
-
-            else:
-                value = float(value)
-
-            gen_node = Struct(type="constant", value_type = float_type, value= value)
-
-        elif ((node.data == "character_constant") or (node.data == "string_literal")):
-            # XXX Needs handling of the escape cases, encodings, etc
-            #     octal-escape-sequence
-            #     hexadecimal-escape-sequence
-            #     universal-character-name
-            # simple_escape_sequence: "\\'" | "\\\"" | "\\?" | "\\" | "\\a" | "\\b" | "\\f" | "\\n" | "\\r" | "\\t" | "\\v"
-
-            assert False, "character_constant / string_literal not supported yet!"
-
-
-        elif (node.data == "identifier"):
-            gen_node = Struct(type="identifier", value=node.children[0].value, dims=None)
-
-        elif (node.data == "declaration_specifiers"):
+        elif (data == "declaration_specifiers"):
             # declaration_specifiers:  storage_class_specifier declaration_specifiers?
             #   |  type_specifier declaration_specifiers?
             #   |  type_qualifier declaration_specifiers?
             #   |  function_specifier declaration_specifiers?
 
             # This is a right recursive list, collect
-            if (node.children[0].data == "type_specifier"):
+            if (children[0].data == "type_specifier"):
 
                 # Concatenate str types (ie multiple specifiers), leave others
                 # (struct, union...) alone
                 # XXX What about "const struct", etc...
-                gen_node = generate_ir(generator, node.children[0])
-                if (len(node.children) > 1):
+                gen_node = generate_ir(generator, children[0])
+                if (len(children) > 1):
                     # Note in order to canonicalize the full type is needed, so
                     # this gets canonicalized at usage time in declaration,
                     # function_definition and parameter_declaration
                     
                     assert(isinstance(gen_node, str))
-                    new_node = generate_ir(generator, node.children[1])
+                    new_node = generate_ir(generator, children[1])
                     assert(isinstance(new_node, str))
                     gen_node = gen_node + " " + new_node
                 
@@ -2258,15 +2454,15 @@ def generate_ir(generator, node):
                 #     basic types, once complex types are supported, the types will
                 #     have to be put in the symbol table and parsed properly
             
-                res_type = string.join(res_type, " ")
+                res_type = " ".join(res_type)
                 gen_node = res_type
 
-        elif (node.data == "type_name"):
+        elif (data == "type_name"):
             # type_name:  specifier_qualifier_list abstract_declarator?
-            assert (len(node.children) == 1), "Pointers not supported yet"
+            assert (len(children) == 1), "Pointers not supported yet"
 
             # Collect into single type and bubble up
-            res_type = generate_ir(generator, node.children[0])
+            res_type = generate_ir(generator, children[0])
             # We expect a list of strings or a single element list of complex types
             # XXX Missing dealing with inline, const, etc
             assert isinstance(res_type, list), "Expected list, found %s" % res_type
@@ -2274,7 +2470,7 @@ def generate_ir(generator, node):
             # Unbox/canonicalize the types
             if (isinstance(res_type[0], str)):
                 # Join all specifiers plus type a canonical type
-                res_type = string.join(res_type, " ")
+                res_type = " ".join(res_type)
                 res_type = get_canonical_type(res_type)
 
             else:
@@ -2286,18 +2482,19 @@ def generate_ir(generator, node):
             # array types, only structs
             assert not isinstance(gen_node, list), "List not expected, found %s" % res_type
 
-        elif (node.data == "iteration_statement"):
+        elif (data == "iteration_statement"):
             # iteration_statement:  "while" "(" expression ")" statement
             # |  "do" statement "while" "(" expression ")" ";"
             # |  "for" "(" expression? ";" expression? ";" expression? ")" statement
             # |  "for" "(" declaration expression? ";" expression? ")" statement
-            if (node.children[0] == "while"):
+            if (children[0] == "while"):
                 # iteration_statement:  "while" "(" expression ")" statement
 
                 builder = generator.llvmir.builder
-                loop_cond_bb = builder.function.append_basic_block("whilecond")
-                loop_end_bb = builder.function.append_basic_block("whileend")
-                loop_body_bb = builder.function.append_basic_block("whilebody")
+                append_block = builder.function.append_basic_block
+                loop_cond_bb = append_block("whilecond")
+                loop_end_bb = append_block("whileend")
+                loop_body_bb = append_block("whilebody")
 
                 # Save old break/continue, set new
                 prev_break_bb = generator.llvmir.break_bb
@@ -2309,21 +2506,17 @@ def generate_ir(generator, node):
                 generate_branch_ir(loop_cond_bb)
                 
                 # Generate loop condition
-                generator.llvmir.builder.position_at_start(loop_cond_bb)
-                gen_node = generate_ir(generator, node.children[2])
+                builder.position_at_start(loop_cond_bb)
+                gen_node = generate_ir(generator, children[2])
                 # Convert expression to _Bool
-                a_ir_reg, a_type = get_ir_reg_and_type(gen_node)
-                res_type = "_Bool"
-                if (a_type != res_type):
-                    a_ir_reg = generate_extern_call_ir(generator, 
-                        get_fn_name("cnv", res_type, a_type), res_type, [a_type, a_ir_reg])
+                a_ir_reg = generate_bool_ir(generator, gen_node)
 
                 # Jump to exit or to start of loop
                 generate_cbranch_ir(a_ir_reg, loop_body_bb, loop_end_bb)
 
                 # Generate loop body
-                generator.llvmir.builder.position_at_start(loop_body_bb)
-                generate_ir(generator, node.children[4])
+                builder.position_at_start(loop_body_bb)
+                generate_ir(generator, children[4])
                 generate_branch_ir(loop_cond_bb)
 
                 # Restore old break/continue
@@ -2331,15 +2524,16 @@ def generate_ir(generator, node):
                 generator.llvmir.continue_bb = prev_continue_bb
 
                 # Generate the end
-                generator.llvmir.builder.position_at_start(loop_end_bb)
+                builder.position_at_start(loop_end_bb)
 
-            elif (node.children[0] == "do"):
+            elif (children[0] == "do"):
                 # |  "do" statement "while" "(" expression ")" ";"
 
                 builder = generator.llvmir.builder
-                loop_cond_bb = builder.function.append_basic_block("docond")
-                loop_body_bb = builder.function.append_basic_block("dobody")
-                loop_end_bb = builder.function.append_basic_block("doend")
+                append_block = builder.function.append_basic_block
+                loop_cond_bb = append_block("docond")
+                loop_body_bb = append_block("dobody")
+                loop_end_bb = append_block("doend")
 
                 # Save old break/continue, set new
                 prev_break_bb = generator.llvmir.break_bb
@@ -2351,19 +2545,15 @@ def generate_ir(generator, node):
                 generate_branch_ir(loop_body_bb)
 
                 # Generate loop body
-                generator.llvmir.builder.position_at_start(loop_body_bb)
-                generate_ir(generator, node.children[1])
+                builder.position_at_start(loop_body_bb)
+                generate_ir(generator, children[1])
                 generate_branch_ir(loop_cond_bb)
 
                 # Generate loop condition
-                generator.llvmir.builder.position_at_start(loop_cond_bb)
-                gen_node = generate_ir(generator, node.children[4])
+                builder.position_at_start(loop_cond_bb)
+                gen_node = generate_ir(generator, children[4])
                 # Convert expression to _Bool
-                a_ir_reg, a_type = get_ir_reg_and_type(gen_node)
-                res_type = "_Bool"
-                if (a_type != res_type):
-                    a_ir_reg = generate_extern_call_ir(generator, 
-                        get_fn_name("cnv", res_type, a_type), res_type, [a_type, a_ir_reg])
+                a_ir_reg = generate_bool_ir(generator, gen_node)
 
                 # Jump to exit or to start of loop
                 generate_cbranch_ir(a_ir_reg, loop_body_bb, loop_end_bb)
@@ -2373,9 +2563,9 @@ def generate_ir(generator, node):
                 generator.llvmir.continue_bb = prev_continue_bb
 
                 # Generate the end
-                generator.llvmir.builder.position_at_start(loop_end_bb)
+                builder.position_at_start(loop_end_bb)
 
-            elif (node.children[0] == "for"):
+            elif (children[0] == "for"):
                 # |  "for" "(" expression? ";" expression? ";" expression? ")" statement
                 # |  "for" "(" declaration expression? ";" expression? ")" statement
 
@@ -2389,12 +2579,12 @@ def generate_ir(generator, node):
                 next_child = 2
 
                 # Generate the loop setup
-                if (node.children[next_child] != ";"):
+                if (children[next_child] != ";"):
                     # Declaration or expression, note declaration includes the
                     # initializer and ";" already
-                    gen_node = generate_ir(generator, node.children[next_child])
+                    gen_node = generate_ir(generator, children[next_child])
                     
-                    if (node.children[next_child].data == "expression"):
+                    if (children[next_child].data == "expression"):
                         next_child += 1
 
                 # Skip over ;
@@ -2404,10 +2594,11 @@ def generate_ir(generator, node):
                 
                 builder = generator.llvmir.builder
 
-                loop_cond_bb = builder.function.append_basic_block("forcond")
-                loop_incr_bb = builder.function.append_basic_block("forincr")
-                loop_body_bb = builder.function.append_basic_block("forbody")
-                loop_end_bb = builder.function.append_basic_block("forend")
+                append_block = builder.function.append_basic_block
+                loop_cond_bb = append_block("forcond")
+                loop_incr_bb = append_block("forincr")
+                loop_body_bb = append_block("forbody")
+                loop_end_bb = append_block("forend")
 
                 # Save old break / continue, set new
                 prev_break_bb = generator.llvmir.break_bb
@@ -2417,19 +2608,14 @@ def generate_ir(generator, node):
 
                 generate_branch_ir(loop_cond_bb)
                 
-                generator.llvmir.builder.position_at_start(loop_cond_bb)
-                if (node.children[next_child] != ";"):
+                builder.position_at_start(loop_cond_bb)
+                if (children[next_child] != ";"):
                     # Generate the loop condition
                     
-                    gen_node = generate_ir(generator, node.children[next_child])
+                    gen_node = generate_ir(generator, children[next_child])
 
                     # Convert expression to _Bool
-                    a_ir_reg, a_type = get_ir_reg_and_type(gen_node)
-                    res_type = "_Bool"
-                    if (a_type != res_type):
-                        a_ir_reg = generate_extern_call_ir(generator, 
-                            get_fn_name("cnv", res_type, a_type), res_type, [a_type, a_ir_reg])
-                        a_ir_reg.name = "forcond"
+                    a_ir_reg = generate_bool_ir(generator, gen_node, "forcond")
 
                     # Jump to exit or to start of loop
                     generate_cbranch_ir(a_ir_reg, loop_body_bb, loop_end_bb)
@@ -2441,10 +2627,10 @@ def generate_ir(generator, node):
                 # Skip over ;
                 next_child += 1
 
-                generator.llvmir.builder.position_at_start(loop_incr_bb)
-                if (node.children[next_child] != ")"):
+                builder.position_at_start(loop_incr_bb)
+                if (children[next_child] != ")"):
                     # Generate the loop increment
-                    gen_node = generate_ir(generator, node.children[next_child])
+                    gen_node = generate_ir(generator, children[next_child])
                     gen_node.ir_reg.name = "forcounter"
                     
                     next_child += 1
@@ -2453,12 +2639,12 @@ def generate_ir(generator, node):
                 next_child += 1
 
                 # Generate the for body 
-                generator.llvmir.builder.position_at_start(loop_body_bb)
-                generate_ir(generator, node.children[next_child])
+                builder.position_at_start(loop_body_bb)
+                generate_ir(generator, children[next_child])
                 generate_branch_ir(loop_incr_bb)
                 
                 # Generate the end
-                generator.llvmir.builder.position_at_start(loop_end_bb)
+                builder.position_at_start(loop_end_bb)
 
                 # Restore old break/continue
                 generator.llvmir.break_bb = prev_break_bb
@@ -2472,64 +2658,59 @@ def generate_ir(generator, node):
             else:
                 assert False, "Unsupported iteration statement %s" % node
 
-        elif (node.data == "selection_statement"):
+        elif (data == "selection_statement"):
             # selection_statement:  "if" "(" expression ")" statement
             # |  "if" "(" expression ")" statement "else" statement
             # |  "switch" "(" expression ")" statement
-            if (node.children[0] == "if"):
+            if (children[0] == "if"):
                 # Generate the condition expression
-                gen_node = generate_ir(generator, node.children[2])
-                
-                a_ir_reg, a_type = get_ir_reg_and_type(gen_node)
+                gen_node = generate_ir(generator, children[2])
                 
                 # Convert expression to _Bool
-                res_type = "_Bool"
-                if (a_type != res_type):
-                    a_ir_reg = generate_extern_call_ir(generator, 
-                        get_fn_name("cnv", res_type, a_type), res_type, [a_type, a_ir_reg])
-                    a_ir_reg.name = "ifcond"
+                a_ir_reg = generate_bool_ir(generator, gen_node, "ifcond")
                 
                 builder = generator.llvmir.builder
-                if_then_bb = builder.function.append_basic_block("ifthen")
-                if_else_bb = builder.function.append_basic_block("ifelse")
-                if_end_bb = builder.function.append_basic_block("ifend")
+                append_block = builder.function.append_basic_block
+                if_then_bb = append_block("ifthen")
+                if_else_bb = append_block("ifelse")
+                if_end_bb = append_block("ifend")
                 
                 generate_cbranch_ir(a_ir_reg, if_then_bb, if_else_bb)
 
                 # Generate then
-                generator.llvmir.builder.position_at_start(if_then_bb)
-                generate_ir(generator, node.children[4])
+                builder.position_at_start(if_then_bb)
+                generate_ir(generator, children[4])
                 generate_branch_ir(if_end_bb)
                 
-                generator.llvmir.builder.position_at_start(if_else_bb)
-                if (len(node.children) > 5):
+                builder.position_at_start(if_else_bb)
+                if (len(children) > 5):
                     # Generate else
-                    generate_ir(generator, node.children[6])
+                    generate_ir(generator, children[6])
                 generate_branch_ir(if_end_bb)
 
-                generator.llvmir.builder.position_at_start(if_end_bb)                    
+                builder.position_at_start(if_end_bb)                    
 
                 # XXX Missing gen node
             else:
                 assert False, "Unhandled switch statement"
 
 
-        elif (len(node.children) == 1):
+        elif (len(children) == 1):
             # Unify with the n children below?
             # XXX This catch all should go at some point?
             # XXX This is cumbersome because sometimes we want to always receive
             #     a list to unify handling, on the other hand creating a one 
             #     element list here would do nesting, but it's also convenient
             # XXX Ideally we should handle all nodes individually without catch-all
-            gen_node = generate_ir(generator, node.children[0])
+            gen_node = generate_ir(generator, children[0])
             
         else:
             gen_node = []
-            for child in node.children:
+            for child in children:
                 gen_node.append(generate_ir(generator, child))
 
         if (debug):
-            print "  " * generator.depth, "leave", node.data, str(gen_node)[:100].replace("\n", " - ")
+            print "  " * generator.depth, "leave", data, str(gen_node)[:100].replace("\n", " - ")
 
     elif (isinstance(node, lark.Token)):
         gen_node = node.value
@@ -2568,8 +2749,12 @@ def llvm_compile(llvm_ir, function_signatures):
 
         llvm_initialized = True
 
-        # XXX Reuse some of the objects created below across llvm_compile 
-        #     invocations?
+        # XXX Reuse some of the objects created below across llvm_compile
+        #     invocations? Note sharing was tried and doesn't work on this
+        #     llvmlite: create_mcjit_compiler takes ownership of the target
+        #     machine (sharing it crashes once an engine is collected) and a
+        #     reused pass manager builder was observed to populate different
+        #     passes, changing the optimized IR
 
     def create_target_machine():
         # Create a target machine representing the host
@@ -2660,6 +2845,9 @@ def llvm_compile(llvm_ir, function_signatures):
     #     compiled or under the function name, but most of them are for the
     #     whole jit_lib, not per function
     
+    # Note this emit_assembly cannot be skipped even if nothing reads the
+    # assembly: codegen mutates the module and the optimized IR the tests
+    # compare against depends on running it before the optimization passes
     jit_lib.asm = target_machine.emit_assembly(mod)
     jit_lib.ir = str(mod)
 
@@ -2667,14 +2855,14 @@ def llvm_compile(llvm_ir, function_signatures):
     # runsnakerun, disable it unless debug 
     # XXX Get these from configs and/or expose a generate_dot
     # function
-    debug = (__name__ == "__main__")
+    debug = debug_prints
     output_dot = debug
     output_optimized_dot = debug
     if (output_dot):
         for function_signature in function_signatures:
             func = mod.get_function(function_signature.name)
             dot = llvm.get_function_cfg(func, show_inst=True)
-            dot_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_out", function_signature.name + ".dot")
+            dot_filepath = os.path.join(epycc_dirpath, "_out", function_signature.name + ".dot")
             with open(dot_filepath, "w") as f:
                 f.write(dot)
             invoke_dot(dot_filepath)
@@ -2687,7 +2875,10 @@ def llvm_compile(llvm_ir, function_signatures):
     pm.run(mod)
 
     jit_lib.ir_optimized = str(mod)
-    jit_lib.asm_optimized = target_machine.emit_assembly(mod)
+    # The optimized assembly is only read when debugging, skip the second
+    # backend codegen pass otherwise
+    if (debug):
+        jit_lib.asm_optimized = target_machine.emit_assembly(mod)
 
     # Create the engine and add the module to the engine now that the module has
     # been compiled and optimized. Cannot be added before optimizing or the code
@@ -2719,7 +2910,7 @@ def llvm_compile(llvm_ir, function_signatures):
         if (output_optimized_dot):
             func = mod.get_function(function_signature.name)
             dot = llvm.get_function_cfg(func, show_inst=True)
-            dot_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_out", function_signature.name + ".optimized.dot")
+            dot_filepath = os.path.join(epycc_dirpath, "_out", function_signature.name + ".optimized.dot")
             with open(dot_filepath, "w") as f:
                 f.write(dot)
             invoke_dot(dot_filepath)
@@ -2730,12 +2921,24 @@ def llvm_compile(llvm_ir, function_signatures):
         
         # Convert the Python arguments to ctype arguments by wrapping the ctype
         # function in a Python wrapper
-        if (any(
-                [(issubclass(ctype, ctypes.Array) or issubclass(ctype, ctypes._Pointer)) 
-                for ctype in function_signature.ctypes[1:]]
-            )):
+        # Classify every argument once per signature so the per-call wrapper
+        # below doesn't redo the issubclass checks on each invocation
+        arg_ctype_kinds = []
+        for ctype in function_signature.ctypes[1:]:
+            if (issubclass(ctype, ctypes.Array)):
+                kind = "array"
+            elif (issubclass(ctype, ctypes._Pointer)):
+                kind = "pointer"
+            else:
+                kind = "scalar"
+            arg_ctype_kinds.append((ctype, kind))
+
+        if (any([(kind != "scalar") for ctype, kind in arg_ctype_kinds])):
             # Nested lists need to be converted to nested tuples
-            def wrapper(_cfunc, *args):
+            # Note the classification must be bound into the wrapper like
+            # _cfunc is, closing over the loop variable would leave every
+            # wrapper reading the last compiled function's kinds
+            def wrapper(_cfunc, _arg_ctype_kinds, *args):
                 def tuplize(a):
                     # XXX This assumes that once it finds a tuple everything 
                     #     is tuples all the way
@@ -2749,15 +2952,28 @@ def llvm_compile(llvm_ir, function_signatures):
 
                 _args = []
                 
-                for arg, ctype in zip(args, _cfunc.argtypes):
-                    if (issubclass(ctype, ctypes.Array)):
-                        # Pass the list straight
-                        _args.append(ctype(*tuplize(arg)))
-
-                    elif (issubclass(ctype, ctypes._Pointer)):
+                for arg, (ctype, kind) in zip(args, _arg_ctype_kinds):
+                    if (kind == "array"):
+                        if ((len(arg) > 0) and isinstance(arg[0], list)):
+                            # Pass the list straight
+                            _args.append(ctype(*tuplize(arg)))
+                        else:
+                            # Flat list fast path, slice assignment copies at
+                            # C level instead of unpacking one Python argument
+                            # per element
+                            c_arr = ctype()
+                            c_arr[:] = arg
+                            _args.append(c_arr)
+
+                    elif (kind == "pointer"):
                         # Pointer to array, ignore the pointer, pass an array
-                        tup = tuplize(arg)
-                        c_arr = (len(tup) * ctype._type_)(*tup)
+                        if ((len(arg) > 0) and isinstance(arg[0], list)):
+                            tup = tuplize(arg)
+                            c_arr = (len(tup) * ctype._type_)(*tup)
+                        else:
+                            # Flat list fast path, see above
+                            c_arr = (len(arg) * ctype._type_)()
+                            c_arr[:] = arg
                         _args.append(c_arr)
 
                     else:
@@ -2767,11 +2983,11 @@ def llvm_compile(llvm_ir, function_signatures):
                 res = _cfunc(*_args)
                 
                 # copy back
-                for arg, ctype, _arg in zip(args, _cfunc.argtypes, _args):
-                    if (issubclass(ctype, ctypes.Array)):
+                for arg, (ctype, kind), _arg in zip(args, _arg_ctype_kinds, _args):
+                    if (kind == "array"):
                         assert False, "Missing copy back for array"
 
-                    elif (issubclass(ctype, ctypes._Pointer)):
+                    elif (kind == "pointer"):
                         def deepcopy_list(l, c_arr):
                             for i in xrange(len(l)):
                                 if (isinstance(l[i], list)):
@@ -2783,7 +2999,12 @@ def llvm_compile(llvm_ir, function_signatures):
                         # XXX This assumes that there are no lists if the 
                         #     topmost is not list
                         if (isinstance(arg, list)):
-                            deepcopy_list(arg, _arg)
+                            if ((len(arg) > 0) and isinstance(arg[0], list)):
+                                deepcopy_list(arg, _arg)
+                            else:
+                                # Flat list fast path, the ctypes slice read
+                                # returns the whole array as a list at C level
+                                arg[:] = _arg[:]
 
                     # XXX Other copybacks probably missing like structs, etc
                     #     May go through the pointer path?
@@ -2791,7 +3012,7 @@ def llvm_compile(llvm_ir, function_signatures):
 
             # XXX Ideally this hould only override the __call__ so the 
             #     user still sees a ctypes function
-            cfunc = functools.partial(wrapper, cfunc)
+            cfunc = functools.partial(wrapper, cfunc, arg_ctype_kinds)
         
         setattr(jit_lib, function_signature.name, cfunc)
         setattr(jit_lib, "__raw_" + function_signature.name, raw_cfunc)
@@ -2829,48 +3050,57 @@ def epycc_generate(source, debug = False):
     # XXX check if we can tag which tokens to keep with "!" in the rule instead 
     #     of keep_all_tokens
 
-    grammar_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+    grammar_filepath = os.path.join(epycc_dirpath,
         "grammars", "c99_phrase_structure_grammar.lark")
     use_earley = False
-    if (use_earley):
-        # Use the standard lexer since the earley parser dynamic lexer confuses return
-        # token with an identifier when a parenthesis follows, eg
-        #   float fdouble(float a) {
-        #     return (a * 2.0 + 3.0) * 6.0 ;
-        #   }
-        # Another way of fixing it is by adding a blacklist of keywords to the identifier
-        # terminal:
-        #   IDENTIFIER: /(?!(break|return)\b)/CNAME
-        # but the negative lookahead is probably less efficient, cumbersome to add all
-        # the terminals that may hit that problem, and the grammar doesn't seem to need
-        # the dynamic lexer anyway
-
-        # Earley properly auto resolves ambiguity between identifier and
-        # typedef_name that the LALR(1) chokes on, but it doesn't detect the "T*
-        # t;" ambiguity (this can be seen when opened with ambiguity="explicit",
-        # there are no trees due to T* t; under _ambig node), so still requires
-        # some lexer hack or such (although on a recent test Earley did properly
-        # detect both ambiguous trees, see https://github.com/lark-parser/lark/issues/977#issuecomment-907900877
+
+    # Rebuilding the lark parser costs tens of milliseconds per call even with
+    # the file cache; reuse the built parser across epycc_generate calls until
+    # the grammar file changes
+    parser_key = (grammar_filepath, os.path.getmtime(grammar_filepath), use_earley)
+    parser = parser_cache.get(parser_key, None)
+    if (parser is None):
+        if (use_earley):
+            # Use the standard lexer since the earley parser dynamic lexer confuses return
+            # token with an identifier when a parenthesis follows, eg
+            #   float fdouble(float a) {
+            #     return (a * 2.0 + 3.0) * 6.0 ;
+            #   }
+            # Another way of fixing it is by adding a blacklist of keywords to the identifier
+            # terminal:
+            #   IDENTIFIER: /(?!(break|return)\b)/CNAME
+            # but the negative lookahead is probably less efficient, cumbersome to add all
+            # the terminals that may hit that problem, and the grammar doesn't seem to need
+            # the dynamic lexer anyway
+
+            # Earley properly auto resolves ambiguity between identifier and
+            # typedef_name that the LALR(1) chokes on, but it doesn't detect the "T*
+            # t;" ambiguity (this can be seen when opened with ambiguity="explicit",
+            # there are no trees due to T* t; under _ambig node), so still requires
+            # some lexer hack or such (although on a recent test Earley did properly
+            # detect both ambiguous trees, see https://github.com/lark-parser/lark/issues/977#issuecomment-907900877
         
-        # Note that Earley is 10x slower than LALR with file caching, and causes
-        # stack overflow with long C files (thousands of lines).
-        parser = lark.Lark.open(grammar_filepath, keep_all_tokens="True", 
-            lexer="standard")
+            # Note that Earley is 10x slower than LALR with file caching, and causes
+            # stack overflow with long C files (thousands of lines).
+            parser = lark.Lark.open(grammar_filepath, keep_all_tokens="True", 
+                lexer="standard")
 
-    else:
-        # XXX Optionally once epycc can bootstrap itself, write the parser code
-        #     in C or use some bison/flex to generate the AST (the AST traversal
-        #     can remain in Python).
-        # Workaround https://github.com/lark-parser/lark/issues/977 (unbound
-        # method exists()) to enable caching
-        setattr(lark.utils.FS, 'exists', staticmethod(os.path.exists))
-        # Load LALR and enable caching (LALR 7x faster than Earley, 10x with
-        # file cache)
-        # Note LALR works with both the standard and context lexers, but is not
-        # able to solve the C99 typedef_name / identifier ambiguity, it just picks
-        # identifier over typedef_name
-        parser = lark.Lark.open(grammar_filepath, keep_all_tokens="True", 
-            lexer="standard", parser="lalr", cache=True)
+        else:
+            # XXX Optionally once epycc can bootstrap itself, write the parser code
+            #     in C or use some bison/flex to generate the AST (the AST traversal
+            #     can remain in Python).
+            # Workaround https://github.com/lark-parser/lark/issues/977 (unbound
+            # method exists()) to enable caching
+            setattr(lark.utils.FS, 'exists', staticmethod(os.path.exists))
+            # Load LALR and enable caching (LALR 7x faster than Earley, 10x with
+            # file cache)
+            # Note LALR works with both the standard and context lexers, but is not
+            # able to solve the C99 typedef_name / identifier ambiguity, it just picks
+            # identifier over typedef_name
+            parser = lark.Lark.open(grammar_filepath, keep_all_tokens="True", 
+                lexer="standard", parser="lalr", cache=True)
+
+        parser_cache[parser_key] = parser
 
     tree = parser.parse(source)
 
@@ -2887,6 +3117,9 @@ def epycc_generate(source, debug = False):
             function=None, externs=dict(),
             # Register holding the current stacksave value
             stack_ir_reg = None,
+            # Cached stack intrinsic declarations, declared lazily once per
+            # module
+            stacksave_fn_ir = None, stackrestore_fn_ir = None,
         )
     )
 
@@ -2897,7 +3130,6 @@ def epycc_generate(source, debug = False):
             print "Generation exception in function\n", str(generator.llvmir.function)
         raise
 
-    epycc_dirpath = os.path.dirname(os.path.abspath(__file__))
     generated_c_filepath = os.path.join(epycc_dirpath, "generated", "irs.c")
     generated_ir_filepath = os.path.join(epycc_dirpath, "generated", "irs.ll")
 
@@ -2952,7 +3184,7 @@ def epycc_generate(source, debug = False):
         llvm_irs.append(extern[-1])
         llvm_irs.append("")
 
-    llvm_ir = string.join(llvm_irs, "\n")
+    llvm_ir = "\n".join(llvm_irs)
 
     return llvm_ir, function_signatures
 
@@ -2970,7 +3202,49 @@ def epycc_compile(source, debug = False):
 
 
 
-def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
+# Parsed IR modules keyed by filepath, with the modification time for
+# invalidation, so batch callers (eg the tests calling llvm_ir_diff once per
+# function on the same files) don't pay the parse cost on every call
+parse_ir_file_cache = {}
+
+def parse_ir_file(ir_filepath):
+    """
+    Parse an LLVM IR file and return the llvm module, caching the parsed module
+    across calls until the file changes on disk.
+    """
+    mtime = os.path.getmtime(ir_filepath)
+    mod_mtime = parse_ir_file_cache.get(ir_filepath, None)
+    if ((mod_mtime is None) or (mod_mtime[1] != mtime)):
+        # Keep the cache from growing without bound on long batch runs
+        if (len(parse_ir_file_cache) >= 32):
+            parse_ir_file_cache.clear()
+
+        # Memory-map the file so the OS pages the IR text in directly instead
+        # of copying it through the file object's buffers, large optimized IR
+        # dumps can be tens of MB
+        with open(ir_filepath, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                mod = llvm.parse_assembly(mm[:])
+            finally:
+                mm.close()
+        parse_ir_file_cache[ir_filepath] = (mod, mtime)
+
+    else:
+        mod = mod_mtime[0]
+
+    return mod
+
+
+def llvm_ir_diff_worker(args):
+    # Top level function so multiprocessing can pickle it, diffs a subset of
+    # functions in a worker process. Each worker parses the files on its own
+    # since llvm module objects cannot cross process boundaries
+    filepath_a, filepath_b, function_names = args
+    return llvm_ir_diff(filepath_a, filepath_b, function_names)
+
+
+def llvm_ir_diff(filepath_a, filepath_b, function_names = None, processes = 1):
     """
     IR file differ. Tries to find a remapping of namedvalues between a and b 
     and reordering of phi instructions and reshuffling of phi parameters to
@@ -3052,18 +3326,116 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
             
     """
 
+    # Matches register/namedvalue references for text normalization
+    re_register_name = re.compile(r'%[\w.]+')
+
     def search_block(block_str, blocks):
-        block = block_str_to_block.get(block_str, None)
-        if (block is None):
-            for block in blocks:
-                if (block_str == str(block)):
-                    block_str_to_block[block_str] = block
-                    break
-                
-        return block
-        
+        # Resolve with the prebuilt index instead of a linear scan over all the
+        # blocks. An operand whose text matches no block (eg because the block
+        # contents differ between a and b) resolves to the last block, same as
+        # the linear scan used to do by leaking the loop variable
+        return block_str_to_block.get(block_str, blocks[-1])
+
+    def argument_register_name(argument, i):
+        # Unnamed arguments get the positional register name %0, %1, ...
+        return "%" + (argument.name or str(i))
+
+    def check_tokens_mismatch(opcode_a, opcode_b, tokens_a, tokens_b):
+        """
+        Decide in a single fused pass whether an instruction pair can never
+        match (different lengths, opcodes, or differing non-register tokens
+        that no remapping can fix) and, when it can match, merge the identity
+        remappings of the non-register tokens into the remapping table along
+        the way instead of rescanning the tokens.
+
+        @return True if a mismatch was found
+        """
+        if (len(tokens_a) != len(tokens_b)):
+            return True
+
+        if (opcode_a != opcode_b):
+            return True
+
+        is_phi = (opcode_a == "phi")
+        identity_tokens = []
+        for token_a, token_b in zip(tokens_a, tokens_b):
+            if ((token_b == "") or (token_b[0] != "%")):
+                # Non-register tokens of non-phi instructions have to match
+                # verbatim (phi operands can still be reordered later)
+                if ((not is_phi) and (token_a != token_b)):
+                    return True
+
+                identity_tokens.append(token_b)
+
+        # Only merge the identity remappings once the pair is known to match,
+        # a mismatching instruction contributes no remappings. setdefault
+        # avoids rewriting entries that are already present, the common case
+        # after the first block
+        for token_b in identity_tokens:
+            remapping_table.setdefault(token_b, token_b)
+
+        return False
+
+    def queue_label_operand_blocks(block_pair, instr_a, instr_b):
+        # Find other blocks to traverse by pushing to the queue operands
+        # of type "label"
+        # If the instruction is the empty string, it means one of the
+        # blocks has less instructions, so even if the other instruction
+        # contained labels, we wouldn't know what block to pair it with,
+        # so don't bother queueing any blokcs in that case
+        # XXX Ideally we would add that whole block as mismatches, but
+        #     we may match that block in another way, so we cannot
+        #     naively do it
+        if (isinstance(instr_a, llvm.ValueRef) and isinstance(instr_b, llvm.ValueRef)):
+            for operand_a, operand_b in zip(instr_a.operands, instr_b.operands):
+                # instr.opcode is a string with the opcode, but has
+                # information missing, eg "icmp" for "icmp gte"
+
+                # str(operand) returns type and name, but name is empty for
+                # auto-gen for labels, the str() gives the full basic block
+                # the label points to, do a full text search for that block
+                # and add it to the queue
+
+                if (str(operand_a.type) == "label"):
+                    # Find the block by indexed string lookup
+                    next_block_a = search_block(str(operand_a), blocks_a)
+                    next_block_b = search_block(str(operand_b), blocks_b)
+
+                    assert(next_block_a is not None)
+                    assert(next_block_b is not None)
+
+                    next_block_pair = (next_block_a, next_block_b)
+                    if ((next_block_pair not in done_block_pairs) and
+                        (next_block_pair not in pending_block_pairs) and
+                        (next_block_pair != block_pair)
+                       ):
+
+                        pending_block_pairs_queue.append(next_block_pair)
+                        pending_block_pairs.add(next_block_pair)
+                        if (debug_queue):
+                            print "queued", [hash(b) for b in next_block_pair],
+                            print [(hash(ba), hash(bb)) for ba, bb in pending_block_pairs_queue]
+
+    # Memoized remap-free phi operand sorts keyed by the tokens tuple, a phi
+    # can get its operands sorted several times (once when sorting the block
+    # instructions, once when comparing them)
+    phi_operands_cache = {}
+
     def sort_phi_operands(tokens, remap_sort, remap_result):
         # XXX This accesses the remapping table, should be passed as param?
+        if ((not remap_sort) and (not remap_result)):
+            # The remap-free sort is pure, memoize it; the remapping variants
+            # depend on the current remapping table contents so they cannot
+            # be cached
+            key = tuple(tokens)
+            phi_operands = phi_operands_cache.get(key, None)
+            if (phi_operands is None):
+                operand_groups = [ tuple(tokens[4+i*4:4+(i+1)*4]) for i in (xrange((len(tokens) - 4) / 4)) ]
+                phi_operands = [item for sublist in sorted(operand_groups) for item in sublist]
+                phi_operands_cache[key] = phi_operands
+
+            return phi_operands
+
         phi_operands = [ tokens[4+i*4:4+(i+1)*4] for i in (xrange((len(tokens) - 4) / 4)) ]
         if (remap_sort):
             phi_operands = sorted(phi_operands, key= lambda a: [remapping_table[i] for i in a])
@@ -3078,78 +3450,52 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
 
         return phi_operands
         
-    def sort_instructions(instructions, remapping_table=None):
+    def sort_instructions(instructions, str_instrs, remapping_table=None):
 
-        def cmp_instructions(i0, i1):
+        remap = (remapping_table is not None)
+
+        def get_instruction_sort_key(index_instruction):
             """
-            Compare two (index, instruction) pairs in order to be sorted.
+            Return the sort key for an (index, instruction, text) triple.
 
             Normal instructions will be first in the list, then remapped phis,
             then unremapped phis. If remap is False then all instructions are
             considered remapped.
 
             Right now this does special casing for phi instructions, the other
-            instructions are compared verbatim.
+            instructions are sorted by original position.
             """
-            remap = (remapping_table is not None)
-
-            i0_i, instr0 = i0
-            i1_i, instr1 = i1
-            str_instr0 = str(instr0).strip()
-            str_instr1 = str(instr1).strip()
-            tokens0 = re.split(r"[ ,]+", str_instr0)
-            tokens1 = re.split(r"[ ,]+", str_instr1)
-            
-            res = 0
-            
-            # Sort normal instructions first, then remapped phis, then
-            # unremapped phis (note in all a instructions are considered
-            # remapped)
-            if ((instr0.opcode == "phi") and (instr1.opcode == "phi")):
-                lacks_remappings0 = lacks_remappings1 = False
-                if (remap):
-                    lacks_remappings0 = any([token not in remapping_table for token in tokens0])
-                    lacks_remappings1 = any([token not in remapping_table for token in tokens1])
-
-                if (lacks_remappings0 and lacks_remappings1):
-                    # When both have remappings missing, sort by original order
-                    res = cmp(i0_i, i1_i)
-                
-                elif (lacks_remappings0):
-                    # Instruction missing remappings to the end
-                    res = 1
-                
-                elif (lacks_remappings1):
-                    # Instruction missing remappings to the end
-                    res = -1
+            i, instr, str_instr = index_instruction
 
-                else:
-                    
-                    # Order depending on alphabetically sorted operands 
-                    # XXX This could also check the return type and/or the
-                    #     destination register
-                    phi_operands0 = sort_phi_operands(tokens0, remap, remap)
-                    phi_operands1 = sort_phi_operands(tokens1, remap, remap)
-
-                    res = cmp(phi_operands0, phi_operands1)
-                    # print "comparing", phi_operands0, "vs", phi_operands1
-                    assert(res != 0)
-                    
-            elif (instr0.opcode == "phi"):
-                res = 1
+            if (instr.opcode != "phi"):
+                # Sort by original position
+                return (0, i)
 
-            elif (instr1.opcode == "phi"):
-                res = -1
+            tokens = re.split(r"[ ,]+", str_instr)
 
-            else:
-                # sort by original position
-                res = cmp(i0_i, i1_i)
+            lacks_remappings = False
+            if (remap):
+                # Use a generator expression so any() can short-circuit without
+                # materializing a throwaway list first
+                lacks_remappings = any(token not in remapping_table for token in tokens)
 
-            return res
+            if (lacks_remappings):
+                # Instructions missing remappings to the end, in original order
+                return (2, i)
+
+            # Order depending on alphabetically sorted operands
+            # XXX This could also check the return type and/or the
+            #     destination register
+            return (1, sort_phi_operands(tokens, remap, remap))
+
+        # Precompute one key per instruction instead of using a comparison
+        # function, which would retokenize and resort the phi operands on
+        # every comparison
+        index_instructions = [ (i, instr, str_instr)
+            for i, (instr, str_instr) in enumerate(zip(instructions, str_instrs))]
+        instructions_sorted = [(instr, str_instr)
+            for i, instr, str_instr in sorted(index_instructions, key=get_instruction_sort_key)]
 
-        index_instructions = [ (i, item) for i, item in enumerate(instructions)]
-        instructions_sorted = [item for i, item in sorted(index_instructions, cmp=cmp_instructions)]
-        
         return instructions_sorted
 
 
@@ -3158,18 +3504,47 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
     mismatches = {}
     side_by_sides = {}
 
-    with open(filepath_a, "r") as f:
-        llvm_ir_a = f.read()
+    if (processes != 1):
+        # The per-function diffs are independent of each other, split the
+        # functions in one chunk per process and merge the mismatches.
+        # Note the side by side .remapped.ll / .reordered.ll debug files are
+        # written by every worker for its own subset, so only one subset
+        # survives in them in this mode
+        mod_a = parse_ir_file(filepath_a)
+        fn_names = [fn.name for fn in mod_a.functions]
+        if (function_names is not None):
+            if (isinstance(function_names, str)):
+                function_names = [function_names]
+            function_names = set(function_names)
+            fn_names = [fn_name for fn_name in fn_names if fn_name in function_names]
+
+        if (processes <= 0):
+            processes = multiprocessing.cpu_count()
+
+        fn_name_chunks = [fn_names[i::processes] for i in xrange(processes)]
+        fn_name_chunks = [chunk for chunk in fn_name_chunks if (len(chunk) > 0)]
+
+        pool = multiprocessing.Pool(max(len(fn_name_chunks), 1))
+        try:
+            results = pool.map(llvm_ir_diff_worker,
+                [(filepath_a, filepath_b, chunk) for chunk in fn_name_chunks])
+        finally:
+            pool.close()
+            pool.join()
 
-    with open(filepath_b, "r") as f:
-        llvm_ir_b = f.read()
+        mismatches = {}
+        for result in results:
+            mismatches.update(result)
 
-    mod_a = llvm.parse_assembly(llvm_ir_a)
-    mod_b = llvm.parse_assembly(llvm_ir_b)
+        return mismatches
+
+    mod_a = parse_ir_file(filepath_a)
+    mod_b = parse_ir_file(filepath_b)
+
+    # Index the functions in b by name so each function in a is looked up in
+    # O(1) instead of rescanning all the functions in b
+    fns_b = { fn_b.name : fn_b for fn_b in mod_b.functions }
 
-    fns_a = {}
-    fns_b = {}
-    
     if (function_names is not None):
         if (isinstance(function_names, str)):
             function_names = [function_names]
@@ -3181,10 +3556,8 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
 
         # look for the function in b, note it's intentional this will ignore
         # and not return as diffs the functions in b not present in a
-        for fn_b in mod_b.functions:
-            if (fn_a.name == fn_b.name):
-                break
-        else:
+        fn_b = fns_b.get(fn_a.name, None)
+        if (fn_b is None):
             # fn_a doesn't exist in b, add each instruction to the mismatch
             # XXX Note this will contain comments and the function header, which
             #     won't appear on a regular per block diff where both a and
@@ -3192,44 +3565,67 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
             mismatches[fn_a.name] = [instr for instr in str(fn_a).splitlines()]
             continue
 
+        # Materialize blocks and arguments once, each fn.blocks/fn.arguments
+        # access returns a fresh generator that crosses the llvmlite FFI
+        # boundary for every element
+        blocks_a = list(fn_a.blocks)
+        blocks_b = list(fn_b.blocks)
+
         # Ignore functions with no blocks (declarations)
-        if ((len(list(fn_a.blocks)) == 0) or (len(list(fn_b.blocks)) == 0)):
+        if ((len(blocks_a) == 0) or (len(blocks_b) == 0)):
             continue
-            
+
         function_mismatch_count = 0
         mismatches[fn_a.name] = []
         side_by_sides[fn_a.name] = set()
 
         # Get the entry blocks
-        block_a = list(fn_a.blocks)[0]
-        block_b = list(fn_b.blocks)[0]
+        block_a = blocks_a[0]
+        block_b = blocks_b[0]
+
+        args_a = list(fn_a.arguments)
+        args_b = list(fn_b.arguments)
 
-        # XXX Should this abort if the number of arguments or the return type 
+        # XXX Should this abort if the number of arguments or the return type
         #     is already different?
-        assert(len(list(fn_a.arguments)) == len(list(fn_b.arguments)))
-        
+        assert(len(args_a) == len(args_b))
+
         # Add the function arguments to the remapping table
-        remapping_table = {
-            "%%%s" % argument_b.name if (argument_b.name != "") else "%%%d" % i :
-            "%%%s" % argument_a.name if (argument_a.name != "") else "%%%d" % i 
-                for i, (argument_a, argument_b) in enumerate(zip(fn_a.arguments, fn_b.arguments))
-        }
-        
-        # Add the initial block to the remapping table, this may appear in 
+        remapping_table = dict(zip(
+            (argument_register_name(argument_b, i) for i, argument_b in enumerate(args_b)),
+            (argument_register_name(argument_a, i) for i, argument_a in enumerate(args_a))
+        ))
+
+        # Add the initial block to the remapping table, this may appear in
         # labels but not in a label declaration if the IR uses default naming
-        block_name_a = block_a.name if (block_a.name != "") else "%%%d" % len(list(fn_a.arguments))
-        block_name_b = block_b.name if (block_b.name != "") else "%%%d" % len(list(fn_a.arguments))
+        block_name_a = block_a.name if (block_a.name != "") else "%%%d" % len(args_a)
+        block_name_b = block_b.name if (block_b.name != "") else "%%%d" % len(args_a)
         remapping_table["%%%s" % block_name_b] = block_name_a
 
-        # Block cache for searches
+        # Index the blocks by their full text so label operands can be resolved
+        # with a dict lookup instead of a linear scan over all the blocks per
+        # label operand (str(label operand) is the full text of the basic block
+        # it points to). Use setdefault so identical blocks across a and b
+        # resolve to the first one indexed, same as the linear scan did
         block_str_to_block = dict()
+        for block in blocks_a + blocks_b:
+            block_str_to_block.setdefault(str(block), block)
 
-        pending_block_pairs_queue = [(block_a, block_b)]
+        # Use a deque so popping from the front is O(1), the revisit logic can
+        # re-enqueue blocks many times and a list pop(0) would make the
+        # traversal quadratic in the number of basic blocks
+        pending_block_pairs_queue = deque([(block_a, block_b)])
         pending_block_pairs = set(pending_block_pairs_queue)
         done_block_pairs = set()
         remapping_table_length_at_enqueue_time = {}
+        # Hard cap on how many times a single block pair can be re-enqueued,
+        # backstop against pathological IRs where the remapping table or the
+        # queue composition keep changing on every pass but the phi operands
+        # never become available, which would otherwise revisit forever
+        max_block_pair_revisits = 10
+        block_pair_revisit_counts = {}
         while (len(pending_block_pairs_queue) > 0):
-            block_pair = pending_block_pairs_queue.pop(0)
+            block_pair = pending_block_pairs_queue.popleft()
             pending_block_pairs.remove(block_pair)
             debug_queue = False
             if (debug_queue):
@@ -3240,8 +3636,11 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
             original_remapping_table_length = len(remapping_table)
 
             table_length_queue = remapping_table_length_at_enqueue_time.get(block_pair, None)
-            can_revisit = True
-            if (table_length_queue is not None):
+            # Once the cap is hit the block is processed as is, mapping the
+            # unresolvable phi operands pairwise and reporting them as
+            # mismatches like any other token
+            can_revisit = (block_pair_revisit_counts.get(block_pair, 0) < max_block_pair_revisits)
+            if (can_revisit and (table_length_queue is not None)):
                 if (
                     (table_length_queue.remapping_table_length == len(remapping_table)) and
                     (set(table_length_queue.pending_block_pairs_queue) == set(tuple(pending_block_pairs_queue)))
@@ -3251,32 +3650,83 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
                 #del remapping_table_length_at_enqueue_time[block_pair]
             
             block_a, block_b = block_pair
-            instructions_a = block_a.instructions
-            instructions_b = block_b.instructions
+            # Materialize the instructions and their stripped texts once per
+            # block visit, each str(instr) crosses the llvmlite FFI boundary
+            # and would otherwise be recomputed by the sort and the compare
+            instructions_a = list(block_a.instructions)
+            instructions_b = list(block_b.instructions)
+            str_instrs_a = [str(instr).strip() for instr in instructions_a]
+            str_instrs_b = [str(instr).strip() for instr in instructions_b]
 
             side_by_sides[fn_a.name].add(block_pair)
 
-            # Create a list to be sorted with [(index, instruction_a, instruction_b), ...] 
+            # Create a list to be sorted with [(index, instruction_a, instruction_b), ...]
             # Reorder the phi instructions wrt to a sort func
-            
-            instructions_sorted_a = sort_instructions(instructions_a)
-            instructions_sorted_b = sort_instructions(instructions_b, remapping_table)
+
+            instructions_sorted_a = sort_instructions(instructions_a, str_instrs_a)
+            instructions_sorted_b = sort_instructions(instructions_b, str_instrs_b, remapping_table)
 
             debug_instruction_sorting = False
-            if (debug_instruction_sorting):
-                print "a sorted\n", string.join([str(instr) for instr in instructions_sorted_a], "\n")
-                print "b sorted\n", string.join([str(instr) for instr in instructions_sorted_b], "\n")
+            if (__debug__ and debug_instruction_sorting):
+                # Generator expressions so no intermediate lists are built
+                # when the debug prints are enabled
+                print "a sorted\n", "\n".join(str_instr for instr, str_instr in instructions_sorted_a)
+                print "b sorted\n", "\n".join(str_instr for instr, str_instr in instructions_sorted_b)
 
             needs_revisiting = False
             # If blocks have different number of instructions, fill with empty
             # strings so they are detected as mismatches (will be detected as a
             # mismatch because of different token lengths)
             delta_len_a_b = len(instructions_sorted_a) - len(instructions_sorted_b)
-            instructions_sorted_b.extend([""] * (max(delta_len_a_b, 0)))
-            instructions_sorted_a.extend([""] * (max(-delta_len_a_b, 0)))
-            for instr_a, instr_b in zip(instructions_sorted_a, instructions_sorted_b):
-                str_instr_a = str(instr_a).strip()
-                str_instr_b = str(instr_b).strip()
+            instructions_sorted_b.extend([("", "")] * (max(delta_len_a_b, 0)))
+            instructions_sorted_a.extend([("", "")] * (max(-delta_len_a_b, 0)))
+            for (instr_a, str_instr_a), (instr_b, str_instr_b) in zip(instructions_sorted_a, instructions_sorted_b):
+
+                # Byte-identical instructions always match and any remapping
+                # they would contribute is the identity, skip the tokenization
+                # and remapping work, the dominant cost in the common case of
+                # mostly-equal files, but still walk the label operands so the
+                # traversal reaches the rest of the CFG
+                if (str_instr_a == str_instr_b):
+                    for token_b in re.split(r"[ ,\n]+", str_instr_b):
+                        remapping_table.setdefault(token_b, token_b)
+                    queue_label_operand_blocks(block_pair, instr_a, instr_b)
+                    continue
+
+                # Cache the opcodes, every access is an llvmlite FFI call and
+                # they are checked several times below. The padding
+                # placeholder for blocks of differing sizes is a plain string
+                # without an opcode attribute
+                opcode_a = instr_a.opcode if (str_instr_a != "") else None
+                opcode_b = instr_b.opcode if (str_instr_b != "") else None
+
+                # Normalize both instructions by collapsing every register
+                # name into a placeholder and compare the normalized texts.
+                # When both sides have the same number of registers but the
+                # normalized texts differ, no remapping can make the pair
+                # match, so it can be declared a mismatch without tokenizing.
+                # Phi operands can still be reordered and tbaa tags trimmed
+                # into a match and a register in b is allowed to remap to a
+                # non-register in a, those cases take the tokenized path below
+                normalized_equal = False
+                if ((str_instr_a != "") and (str_instr_b != "") and
+                    (opcode_a != "phi") and (opcode_b != "phi") and
+                    ("!tbaa" not in str_instr_a) and ("!tbaa" not in str_instr_b)):
+                    normalized_a, register_count_a = re_register_name.subn("%r", str_instr_a)
+                    normalized_b, register_count_b = re_register_name.subn("%r", str_instr_b)
+                    if ((register_count_a == register_count_b) and
+                        (normalized_a != normalized_b)):
+                        function_mismatch_count += 1
+                        mismatches[fn_a.name].append((str_instr_a, str_instr_b))
+                        queue_label_operand_blocks(block_pair, instr_a, instr_b)
+                        continue
+
+                    # Equal normalized texts guarantee equal lengths, opcodes
+                    # and non-register tokens, so the fused token check below
+                    # can be skipped, only the register remapping consistency
+                    # is left to verify
+                    normalized_equal = (normalized_a == normalized_b)
+
                 # Note some operations (eg switch) include carriage returns,
                 # remove those too
                 tokens_a = re.split(r"[ ,\n]+", str_instr_a)
@@ -3294,20 +3744,15 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
 
                 # If the instruction has different lengths, or opcodes, or
                 # non-register tokens that cannot be rearranged, no remapping
-                # will make it match, add to mismatches early
+                # will make it match, add to mismatches early (not needed if
+                # the normalized texts already compared equal above)
                 mismatch_found = False
-                if ((len(tokens_a) != len(tokens_b)) or 
-                    (instr_a.opcode != instr_b.opcode) or 
-                    ((instr_a.opcode != "phi") and any([token_a != token_b 
-                        for token_a, token_b in zip(tokens_a, tokens_b) if not token_b.startswith("%")]))):
-
-                    mismatch_found = True
+                if (not normalized_equal):
+                    mismatch_found = check_tokens_mismatch(opcode_a, opcode_b, tokens_a, tokens_b)
 
-                else:
+                if (not mismatch_found):
                     # Try to remap registers to make instructions match
 
-                    remapping_table.update({token_b : token_b for token_b in tokens_b if token_b[0] != "%"})
-
                     # Phi instructions 
                     #   %indvars.iv10 = phi i32 [ %indvars.iv.next11, %forend.1 ], [ -4, %entry ]
                     # select over depending on where it came from
@@ -3320,11 +3765,11 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
 
                     # ['%10', '=', 'phi', 'i32', '[', '%5', '%4', ']', '[', '%8', '%7', ']']
                     # ['%merge', '=', 'phi', 'i32', '[', '%2', '%dobody.endif', ']', '[', '%.4.0', '%dobody', ']']
-                    if (instr_a.opcode == "phi"):
+                    if (opcode_a == "phi"):
                         # If not all the tokens are in the remapping table, put
                         # the block back in the queue to revisit later
                         
-                        if (any([token_b not in remapping_table for token_b in tokens_b])):
+                        if (any(token_b not in remapping_table for token_b in tokens_b)):
                             # Tag the block as needing revisit, but still look
                             # at the other instructions to find more mismatches
                             # or blocks to traverse
@@ -3353,44 +3798,7 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
                     function_mismatch_count += 1
                     mismatches[fn_a.name].append((str_instr_a, str_instr_b))
 
-                # Find other blocks to traverse by pushing to the queue operands
-                # of type "label"
-                # If the instruction is the empty string, it means one of the
-                # blocks has less instructions, so even if the other instruction
-                # contained labels, we wouldn't know what block to pair it with,
-                # so don't bother queueing any blokcs in that case 
-                # XXX Ideally we would add that whole block as mismatches, but
-                #     we may match that block in another way, so we cannot
-                #     naively do it
-                if (isinstance(instr_a, llvm.ValueRef) and isinstance(instr_b, llvm.ValueRef)):
-                    for operand_a, operand_b in zip(instr_a.operands, instr_b.operands):
-                        # instr.opcode is a string with the opcode, but has
-                        # information missing, eg "icmp" for "icmp gte" 
-
-                        # str(operand) returns type and name, but name is empty for
-                        # auto-gen for labels, the str() gives the full basic block
-                        # the label points to, do a full text search for that block
-                        # and add it to the queue
-
-                        if (str(operand_a.type) == "label"):
-                            # Find the block by string search
-                            next_block_a = search_block(str(operand_a), fn_a.blocks)
-                            next_block_b = search_block(str(operand_b), fn_b.blocks)
-                            
-                            assert(next_block_a is not None)
-                            assert(next_block_b is not None)
-                            
-                            next_block_pair = (next_block_a, next_block_b)
-                            if ((next_block_pair not in done_block_pairs) and 
-                                (next_block_pair not in pending_block_pairs) and 
-                                (next_block_pair != block_pair)
-                               ):
-                                
-                                pending_block_pairs_queue.append(next_block_pair)
-                                pending_block_pairs.add(next_block_pair)
-                                if (debug_queue):
-                                    print "queued", [hash(b) for b in next_block_pair],
-                                    print [(hash(ba), hash(bb)) for ba, bb in pending_block_pairs_queue]
+                queue_label_operand_blocks(block_pair, instr_a, instr_b)
 
             # Re-enqueue if this block needs revisiting, 
             if (needs_revisiting):
@@ -3407,6 +3815,8 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
                     pending_block_pairs_queue = original_pending_block_pairs_queue
                 )
                 
+                block_pair_revisit_counts[block_pair] = block_pair_revisit_counts.get(block_pair, 0) + 1
+
                 # XXX This could remove the completely remapped instructions
                 #     from the block
                 pending_block_pairs_queue.append(block_pair)
@@ -3439,8 +3849,8 @@ def llvm_ir_diff(filepath_a, filepath_b, function_names = None):
             fn_a_unremapped.append(str(block_a))
         # Merge the strings in a single string
         side_by_sides[fn_a.name] = [
-            string.join(fn_a_remapped, "\n"),
-            string.join(fn_a_unremapped, "\n")
+            "\n".join(fn_a_remapped),
+            "\n".join(fn_a_unremapped)
         ]
 
         mismatch_count += function_mismatch_count
@@ -3466,7 +3876,7 @@ def generate_dot(llvm_ir_filepath):
         for fn in mod.functions:
             func = mod.get_function(fn.name)
             dot = llvm.get_function_cfg(func, show_inst=True)
-            dot_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_out", 
+            dot_filepath = os.path.join(epycc_dirpath, "_out", 
                 os.path.basename(llvm_ir_filepath) + "_" + fn.name + ".dot"
             )
             with open(dot_filepath, "w") as f: